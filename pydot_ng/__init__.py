@@ -13,19 +13,68 @@
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import collections
+import contextlib
 import copy
 import functools
+import io
+import mmap
 import os
 import re
+import shutil
+import signal
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import warnings
 from operator import itemgetter
+from timeit import default_timer
 
 try:
-    from pydot_ng import _dotparser as dot_parser
-except Exception:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Module __getattr__ lets the parser be imported on first use, only
+# since Python 3.7.
+LAZY_IMPORTS = sys.version_info >= (3, 7)
+
+
+def find_dot_parser():
+    """Tell whether the dot language parser can be imported.
+
+    From Python 3.7 the parser, and pyparsing with it, is only imported
+    once a graph is loaded, which keeps importing this module fast.
+    """
+    from importlib.util import find_spec
+
+    try:
+        return (find_spec('pyparsing') is not None and
+                find_spec('pydot_ng._dotparser') is not None)
+    except (ImportError, ValueError):
+        return False
+
+
+def _get_dot_parser():
+    # The parser module, imported by the first call from Python 3.7.
+    from pydot_ng import _dotparser
+    return _dotparser
+
+
+if LAZY_IMPORTS:
+    dot_parser_found = find_dot_parser()
+else:
+    try:
+        from pydot_ng import _dotparser as dot_parser  # noqa: F401
+        dot_parser_found = True
+    except Exception:
+        dot_parser_found = False
+
+if not dot_parser_found:
     warnings.warn(
         "Couldn't import _dotparser, "
         "loading of dot files will not be possible."
@@ -37,6 +86,9 @@ __version__ = '2.0.1.dev0'
 
 PY3 = not sys.version_info < (3, 0, 0)
 
+# The size of the chunks Dot.write() copies the output of Graphviz in.
+STREAM_CHUNK_SIZE = 64 * 1024
+
 if PY3:
     NULL_SEP = b''
     basestring = str
@@ -99,6 +151,18 @@ CLUSTER_ATTRIBUTES = set([
     'penwidth', 'peripheries', 'sortv', 'style', 'target', 'tooltip'])
 
 
+# The attributes which don't move anything in a layout, ignored by
+# LayoutCache when telling whether two graphs can share theirs.
+STYLE_ATTRIBUTES = set([
+    'URL', 'arrowhead', 'arrowtail', 'bgcolor', 'class', 'color',
+    'colorscheme', 'comment', 'edgehref', 'edgetarget', 'edgetooltip',
+    'edgeURL', 'fillcolor', 'fontcolor', 'gradientangle', 'headhref',
+    'headlabel', 'headtarget', 'headtooltip', 'headURL', 'href', 'id',
+    'label', 'labelfontcolor', 'labelhref', 'labeltarget', 'labeltooltip',
+    'labelURL', 'pencolor', 'penwidth', 'style', 'tailhref', 'taillabel',
+    'tailtarget', 'tailtooltip', 'tailURL', 'target', 'tooltip', 'xlabel'])
+
+
 def is_string_like(obj):
     """Check if obj is string. from John Hunter, types-free version"""
     try:
@@ -204,13 +268,107 @@ class frozendict(dict):
 
 dot_keywords = ['graph', 'subgraph', 'digraph', 'node', 'edge', 'strict']
 
-id_re_alpha_nums = re.compile('^[_a-zA-Z][a-zA-Z0-9_,]*$', re.UNICODE)
-id_re_alpha_nums_with_ports = re.compile(
-    '^[_a-zA-Z][a-zA-Z0-9_,:\"]*[a-zA-Z0-9_,\"]+$', re.UNICODE)
-id_re_num = re.compile('^[0-9,]+$', re.UNICODE)
-id_re_with_port = re.compile('^([^:]*):([^:]*)$', re.UNICODE)
-id_re_dbl_quoted = re.compile('^\".*\"$', re.S | re.UNICODE)
-id_re_html = re.compile('^<.*>$', re.S | re.UNICODE)
+# The regular expressions telling the kinds of IDs, compiled the first
+# time they are used by get_id_res(), or on import before Python 3.7.
+ID_PATTERNS = {
+    'id_re_alpha_nums': ('^[_a-zA-Z][a-zA-Z0-9_,]*$', re.UNICODE),
+    'id_re_alpha_nums_with_ports': (
+        '^[_a-zA-Z][a-zA-Z0-9_,:\"]*[a-zA-Z0-9_,\"]+$', re.UNICODE),
+    'id_re_num': ('^[0-9,]+$', re.UNICODE),
+    'id_re_with_port': ('^([^:]*):([^:]*)$', re.UNICODE),
+    'id_re_dbl_quoted': ('^\".*\"$', re.S | re.UNICODE),
+    'id_re_html': ('^<.*>$', re.S | re.UNICODE),
+}
+ID_RES = dict()
+
+
+def can_replace(path):
+    """Whether the file at path can be replaced by another one.
+
+    Only plain files with a single link, owned by the user and in a
+    directory the user can write to are, replacing them keeps them as
+    they were. Anything else, such as links, devices, or a path which
+    doesn't exist, isn't.
+    """
+    if os.name != 'posix':
+        return False
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISREG(info.st_mode) and info.st_nlink == 1 and
+            info.st_uid == os.geteuid() and
+            os.access(os.path.dirname(os.path.abspath(path)), os.W_OK))
+
+
+@contextlib.contextmanager
+def open_output(path):
+    """Open path for writing an output, as get_fobj() does in binary mode.
+
+    If writing it fails, a file created for it is removed, and a file
+    which can_replace() is left untouched: it's written under a
+    temporary name next to it, renamed over it once written. Other
+    paths are written in place.
+    """
+    if not is_string_like(path):
+        fobj, close = get_fobj(path, 'w+b')
+        try:
+            yield fobj
+        finally:
+            if close:
+                fobj.close()
+        return
+
+    tmp_name = None
+    created = False
+    if can_replace(path):
+        fd, tmp_name = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)))
+        shutil.copymode(path, tmp_name)
+        fobj = os.fdopen(fd, 'w+b')
+    else:
+        created = not os.path.lexists(path)
+        fobj = open(path, 'w+b')
+
+    try:
+        try:
+            yield fobj
+        finally:
+            fobj.close()
+    except BaseException:
+        if tmp_name is not None:
+            os.unlink(tmp_name)
+        elif created:
+            os.unlink(path)
+        raise
+
+    if tmp_name is not None:
+        os.rename(tmp_name, path)
+
+
+def get_id_res():
+    """Return the compiled ID_PATTERNS, by name."""
+    if not ID_RES:
+        for name, (pattern, flags) in ID_PATTERNS.items():
+            ID_RES[name] = re.compile(pattern, flags)
+    return ID_RES
+
+
+if not LAZY_IMPORTS:
+    globals().update(get_id_res())
+
+
+def __getattr__(name):
+    # The names which used to be set on import, resolved on first use
+    # since Python 3.7.
+    if name in ID_PATTERNS:
+        return get_id_res()[name]
+
+    if name == 'dot_parser':
+        return _get_dot_parser()
+
+    raise AttributeError(
+        'module %r has no attribute %r' % (__name__, name))
 
 
 def needs_quotes(s):
@@ -232,17 +390,19 @@ def needs_quotes(s):
     if s in dot_keywords:
         return False
 
+    id_res = ID_RES or get_id_res()
+
     chars = [ord(c) for c in s if ord(c) > 0x7f or ord(c) == 0]
-    if chars and not id_re_dbl_quoted.match(s) and not id_re_html.match(s):
+    if (chars and not id_res['id_re_dbl_quoted'].match(s) and
+            not id_res['id_re_html'].match(s)):
         return True
 
-    for test_re in [
-            id_re_alpha_nums, id_re_num, id_re_dbl_quoted,
-            id_re_html, id_re_alpha_nums_with_ports]:
-        if test_re.match(s):
+    for name in ('id_re_alpha_nums', 'id_re_num', 'id_re_dbl_quoted',
+                 'id_re_html', 'id_re_alpha_nums_with_ports'):
+        if id_res[name].match(s):
             return False
 
-    m = id_re_with_port.match(s)
+    m = id_res['id_re_with_port'].match(s)
     if m:
         return needs_quotes(m.group(1)) or needs_quotes(m.group(2))
 
@@ -272,30 +432,104 @@ def quote_if_necessary(s):
     return s
 
 
-def graph_from_dot_data(data):
+def graph_from_dot_data(data, lazy=False):
     """Load graph as defined by data in DOT format.
 
     The data is assumed to be in DOT format. It will
     be parsed and a Dot class will be returned,
     representing the graph.
+
+    If 'lazy' is True the bodies of the subgraphs declared
+    in the top graph are not parsed right away. Each one is
+    parsed the first time it is accessed, through get_subgraph(),
+    get_subgraph_list() or when the graph is serialized.
     """
 
-    return dot_parser.parse_dot_data(data)
+    return _get_dot_parser().parse_dot_data(data, lazy=lazy)
 
 
-def graph_from_dot_file(path):
+def graph_from_dot_file(path, lazy=False):
     """Load graph as defined by a DOT file.
 
     The file is assumed to be in DOT format. It will
     be loaded, parsed and a Dot class will be returned,
     representing the graph.
+
+    Refer to graph_from_dot_data for the meaning of 'lazy'. The
+    subgraphs loaded lazily are read from the file when first used,
+    pydot.Error is raised if it changed meanwhile.
+    """
+
+    with open(path, 'rb') as fd:
+        data = map_file(fd)
+
+    try:
+        return _get_dot_parser().parse_dot_data(
+            data, lazy=lazy, path=os.path.abspath(path))
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def graph_from_dot_stream(stream, lazy=False):
+    """Load graph as defined by DOT data read from a file object.
+
+    The stream can be opened in text or binary mode. Binary data
+    is decoded as it is read, and gzip or bz2 compressed data
+    is decompressed on the fly.
+
+    Refer to graph_from_dot_data for the meaning of 'lazy'.
+    """
+
+    from pydot_ng import _dotscan
+    return graph_from_dot_data(_dotscan.read_dot_stream(stream), lazy=lazy)
+
+
+def map_file(fd):
+    """Map the contents of a file opened in binary mode into memory.
+
+    A memory map lets the file be decoded without first reading
+    it into a bytes object. The contents are read as usual when
+    the file can't be mapped, e.g. if it is empty.
+    """
+    if PY3:
+        try:
+            return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            pass
+
+    return fd.read()
+
+
+def dot_stats(path_or_data):
+    """Collect structural statistics of a graph in DOT format.
+
+    'path_or_data' can be the DOT data itself, as a string or bytes,
+    a file object or the path to a DOT file. The data is only
+    tokenized, no Node, Edge or Graph instances are created, which
+    makes this much cheaper than loading the graph.
+
+    It returns a dictionary with the keys 'graph_type', 'strict',
+    'nodes', 'edges', 'subgraphs', 'clusters', 'max_depth' and
+    'attributes'. A list of dictionaries is returned if the data
+    contains several graphs.
     """
 
-    fd = open(path, 'rb')
-    data = fd.read()
-    fd.close()
+    from pydot_ng import _dotscan
 
-    return graph_from_dot_data(data)
+    if hasattr(path_or_data, 'read'):
+        data = _dotscan.read_dot_stream(path_or_data)
+    elif isinstance(path_or_data, basestring) and '{' not in path_or_data:
+        with open(path_or_data, 'rb') as fd:
+            data = map_file(fd)
+    else:
+        data = path_or_data
+
+    try:
+        return _dotscan.scan_dot_stats(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
 
 
 def graph_from_edges(edge_list, node_prefix='', directed=False):
@@ -454,11 +688,103 @@ def __find_executables(path):
     return None
 
 
-# The multi-platform version of this 'find_graphviz' function was
-# contributed by Peter Cock
-def find_graphviz():
+# The environment variable naming the directory with Graphviz's
+# executables, searched instead of the default locations when set.
+GRAPHVIZ_PATH_VARIABLE = 'PYDOT_NG_GRAPHVIZ_PATH'
+
+# The result of the last search of Graphviz's executables and what
+# probe_graphviz() found out about them.
+GRAPHVIZ_CACHE = {'key': None, 'progs': None, 'probes': dict()}
+GRAPHVIZ_LOCK = threading.Lock()
+
+
+def find_graphviz(refresh=False):
     """Locate Graphviz's executables in the system.
 
+    The search is done once per process and repeated only when the PATH
+    or PYDOT_NG_GRAPHVIZ_PATH environment variables change, or when
+    'refresh' is True.
+
+    If PYDOT_NG_GRAPHVIZ_PATH is set, the executables are only looked
+    for in the directories it lists. Otherwise refer to search_graphviz()
+    for where they are looked for.
+
+    It will return a dictionary containing the program names as keys
+    and their paths as values.
+
+    If this fails, it returns None.
+    """
+    key = (os.environ.get(GRAPHVIZ_PATH_VARIABLE), os.environ.get('PATH'))
+
+    with GRAPHVIZ_LOCK:
+        if refresh or GRAPHVIZ_CACHE['key'] != key:
+            if key[0] is not None:
+                progs = None
+                for path in key[0].split(os.pathsep):
+                    progs = __find_executables(path)
+                    if progs is not None:
+                        break
+            else:
+                progs = search_graphviz()
+
+            GRAPHVIZ_CACHE['key'] = key
+            GRAPHVIZ_CACHE['progs'] = progs
+
+        progs = GRAPHVIZ_CACHE['progs']
+
+    # Callers are free to modify what they get.
+    if progs is not None:
+        progs = dict(progs)
+    return progs
+
+
+def probe_graphviz(path):
+    """Ask the Graphviz program at 'path' what it supports.
+
+    Returns a dictionary with the output formats it can render, under
+    'formats', and its layout engines, under 'layouts'. Each program is
+    only asked once per process, unless it changes. Returns None if it
+    can't be run.
+    """
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+    key = (path, stat.st_mtime, stat.st_size)
+
+    with GRAPHVIZ_LOCK:
+        if key in GRAPHVIZ_CACHE['probes']:
+            return GRAPHVIZ_CACHE['probes'][key]
+
+    # Given an unknown value, Graphviz lists the known ones like:
+    #   Format: "?" not recognized. Use one of: bmp canon cmap ...
+    capabilities = dict()
+    for name, option in (('formats', '-T?'), ('layouts', '-K?')):
+        try:
+            p = subprocess.Popen(
+                [path, option],
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            stdout_output, stderr_output = p.communicate()
+        except EnvironmentError:
+            return None
+
+        if PY3:
+            stderr_output = stderr_output.decode('utf-8', 'replace')
+        values = stderr_output.partition('Use one of:')[2].split()
+        capabilities[name] = sorted(set(values))
+
+    with GRAPHVIZ_LOCK:
+        GRAPHVIZ_CACHE['probes'][key] = capabilities
+
+    return capabilities
+
+
+# The multi-platform version of this 'search_graphviz' function was
+# contributed by Peter Cock
+def search_graphviz():
+    """Search Graphviz's executables in the system, see find_graphviz().
+
     Tries three methods:
 
     First: Windows Registry (Windows only)
@@ -691,6 +1017,8 @@ class Common(object):
         return self.obj_dict['sequence']
 
     def create_attribute_methods(self, obj_attributes):
+        # The classes of this module get these methods from
+        # add_attribute_methods(), this is kept for subclasses calling it.
         for attr in obj_attributes:
             # Generate all the Setter methods.
             self.__setattr__(
@@ -703,6 +1031,32 @@ class Common(object):
                              lambda a=attr: self.__get_attribute__(a))
 
 
+def add_attribute_methods(cls, obj_attributes):
+    """Define the set_'attribute' and get_'attribute' methods of a class.
+
+    A setter and a getter are defined for each of the attributes in
+    'obj_attributes' which the class doesn't define already.
+    """
+    def make_setter(attr):
+        def setter(self, value):
+            self.obj_dict['attributes'][attr] = value
+        return setter
+
+    def make_getter(attr):
+        def getter(self):
+            return self.__get_attribute__(attr)
+        return getter
+
+    for attr in obj_attributes:
+        for prefix, make_method in (('set_', make_setter),
+                                    ('get_', make_getter)):
+            name = str(prefix + attr)
+            if name not in cls.__dict__:
+                method = make_method(attr)
+                method.__name__ = name
+                setattr(cls, name, method)
+
+
 class Error(Exception):
     """General error handling class."""
     def __init__(self, value):
@@ -714,13 +1068,196 @@ class Error(Exception):
 
 class InvocationException(Exception):
     """Indicate a ploblem occurred running any of the GraphViz executables."""
-    def __init__(self, value):
+    def __init__(self, value, *args):
         self.value = value
 
     def __str__(self):
         return self.value
 
 
+class InvocationTimeout(InvocationException):
+    """Indicate a GraphViz executable ran for longer than allowed.
+
+    What the program wrote to stderr until then is in 'stderr'.
+    """
+    def __init__(self, value, stderr=''):
+        super(InvocationTimeout, self).__init__(value, stderr)
+        self.stderr = stderr
+
+
+# The callables notified of the time spent rendering and parsing graphs,
+# refer to add_instrumentation_hook().
+INSTRUMENTATION_HOOKS = []
+
+
+def add_instrumentation_hook(hook):
+    """Register a callable notified of the time each step of the work takes.
+
+    The hook is called as hook(phase, duration, info) after each phase
+    of Dot.create() and of graph_from_dot_data(), in the thread which
+    did the work. 'duration' is in seconds and 'info' is a dictionary
+    with the amount of data involved, depending on the phase:
+
+        create.serialize    the graph to dot language: 'bytes'
+        create.cache        looking up the render cache: 'hit'
+        create.stage        placing the shape files: 'files'
+        create.spawn        starting the program
+        create.run          the program running until its output is
+                            read: 'status', 'stdout_bytes', 'stderr_bytes'
+        create.render       rendering through libgvc: 'bytes'
+        create.cleanup      releasing the shape files
+        parse.scan          finding the subgraphs to load lazily:
+                            'subgraphs'
+        parse.decode        decoding the data: 'bytes', 'chars'
+        parse.parse         parsing it: 'graphs', 'nodes', 'edges',
+                            'subgraphs'
+        parse.link          linking lazily loaded subgraphs to the data
+
+    Hooks can also be registered for a single graph with
+    Dot.add_instrumentation_hook(). No timing is done while there are
+    no hooks.
+    """
+    INSTRUMENTATION_HOOKS.append(hook)
+
+
+def remove_instrumentation_hook(hook):
+    """Unregister a hook registered with add_instrumentation_hook()."""
+    INSTRUMENTATION_HOOKS.remove(hook)
+
+
+def notify_hooks(hooks, phase, start, **info):
+    """Call the instrumentation hooks for a phase which started at 'start'.
+
+    'start' is a time given by timeit.default_timer().
+    """
+    duration = default_timer() - start
+    for hook in hooks:
+        hook(phase, duration, info)
+
+
+def decode_stderr(stderr_output):
+    """Decode what a GraphViz program wrote to stderr, for reporting."""
+    if stderr_output and PY3:
+        stderr_output = stderr_output.decode(
+            getattr(sys.stderr, 'encoding', None) or 'utf-8', 'replace')
+    return stderr_output
+
+
+def get_rlimits(limits):
+    # The resource limits of 'limits', as (resource, (soft, hard)).
+    try:
+        import resource
+    except ImportError:
+        return []
+
+    rlimits = []
+    for name, limit in (('cpu_time', 'RLIMIT_CPU'),
+                        ('address_space', 'RLIMIT_AS')):
+        if limits.get(name) is not None and hasattr(resource, limit):
+            value = int(limits[name])
+            rlimits.append((getattr(resource, limit), (value, value)))
+    return rlimits
+
+
+def get_popen_limits(limits):
+    """Return the arguments for subprocess.Popen() applying 'limits'.
+
+    When any of 'timeout', 'cpu_time' or 'address_space' is set, the
+    program gets a session of its own on POSIX, so that kill_process()
+    stops whatever it starts too. Otherwise it stays in the caller's
+    process group and gets its signals, such as Ctrl-C.
+
+    'cpu_time', in seconds, and 'address_space', in bytes, are set with
+    resource.setrlimit() in preexec_fn, so they hold before the program
+    starts.
+    """
+    if os.name != 'posix' or all(
+            limits.get(name) is None
+            for name in ('timeout', 'cpu_time', 'address_space')):
+        return dict()
+
+    rlimits = get_rlimits(limits)
+    if not rlimits and PY3:
+        return {'start_new_session': True}
+
+    import resource
+
+    def preexec():
+        if not PY3:
+            os.setsid()
+        for limit, values in rlimits:
+            resource.setrlimit(limit, values)
+
+    if PY3:
+        return {'start_new_session': True, 'preexec_fn': preexec}
+    return {'preexec_fn': preexec}
+
+
+def kill_process(process):
+    """Kill a program started with get_popen_limits() and its children.
+
+    Only the program is killed if it has no process group of its own.
+    """
+    try:
+        if os.name == 'posix' and os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except EnvironmentError:
+        # It exited already.
+        pass
+
+
+@contextlib.contextmanager
+def reap_on_error(process):
+    """Kill a program and wait for it if the block raises.
+
+    Wraps what is done with a program from its start until it's waited
+    for, so that no error leaves it running or unreaped.
+    """
+    try:
+        yield process
+    except BaseException:
+        kill_process(process)
+        process.wait()
+        raise
+
+
+class Watchdog(object):
+    """Kills a program still running after 'timeout' seconds.
+
+    Used as a context manager around waiting for the program. 'fired'
+    tells whether it had to be killed.
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.fired = False
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.fire)
+            self.timer.daemon = True
+
+    def fire(self):
+        self.fired = True
+        kill_process(self.process)
+
+    def start(self):
+        if self.timer is not None:
+            self.timer.start()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.cancel()
+
+
 class Node(Common):
     """A graph node.
 
@@ -764,8 +1301,6 @@ class Node(Common):
             self.obj_dict['name'] = quote_if_necessary(name)
             self.obj_dict['port'] = port
 
-        self.create_attribute_methods(NODE_ATTRIBUTES)
-
     def set_name(self, node_name):
         """Set the node's name."""
         self.obj_dict['name'] = node_name
@@ -817,6 +1352,9 @@ class Node(Common):
         return node + ';'
 
 
+add_attribute_methods(Node, NODE_ATTRIBUTES)
+
+
 class Edge(Common):
     """A graph edge.
 
@@ -869,8 +1407,6 @@ class Edge(Common):
 
             self.obj_dict['points'] = points
 
-        self.create_attribute_methods(EDGE_ATTRIBUTES)
-
     def get_source(self):
         """Get the edges source node name."""
         return self.obj_dict['points'][0]
@@ -983,6 +1519,9 @@ class Edge(Common):
         return ' '.join(edge) + ';'
 
 
+add_attribute_methods(Edge, EDGE_ATTRIBUTES)
+
+
 class Graph(Common):
     """Class representing a graph in Graphviz's dot language.
 
@@ -1026,6 +1565,10 @@ class Graph(Common):
 
         if obj_dict is not None:
             self.obj_dict = obj_dict
+
+            # Subgraphs loaded lazily are parsed once they are first used.
+            if 'lazy_source' in obj_dict:
+                _get_dot_parser().load_lazy_subgraph(obj_dict)
         else:
             self.obj_dict = dict()
 
@@ -1050,8 +1593,6 @@ class Graph(Common):
 
             self.set_parent_graph(self)
 
-        self.create_attribute_methods(GRAPH_ATTRIBUTES)
-
     def get_graph_type(self):
         return self.obj_dict['type']
 
@@ -1402,7 +1943,10 @@ class Graph(Common):
 
         sgraph.set_sequence(self.get_next_sequence_number())
 
-        sgraph.set_parent_graph(self.get_parent_graph())
+        # Walking the whole subgraph can be skipped when it is already
+        # linked to the right graph, as is the case for parsed graphs.
+        if sgraph.get_parent_graph() is not self.get_parent_graph():
+            sgraph.set_parent_graph(self.get_parent_graph())
 
     def get_subgraph(self, name):
         """Retrieved a subgraph from the graph.
@@ -1545,6 +2089,9 @@ class Graph(Common):
         return ''.join(graph)
 
 
+add_attribute_methods(Graph, GRAPH_ATTRIBUTES)
+
+
 class Subgraph(Graph):
 
     """Class representing a subgraph in Graphviz's dot language.
@@ -1631,7 +2178,855 @@ class Cluster(Graph):
             self.obj_dict['type'] = 'subgraph'
             self.obj_dict['name'] = 'cluster_' + graph_name
 
-        self.create_attribute_methods(CLUSTER_ATTRIBUTES)
+
+add_attribute_methods(Cluster, CLUSTER_ATTRIBUTES)
+
+
+class RenderCache(object):
+    """A cache for the output of the GraphViz programs.
+
+    Rendered graphs are kept in memory, evicting the least recently
+    used ones once their total size goes over 'max_bytes'. If a
+    'directory' is given every rendered graph is stored there too,
+    so it outlives the process and can be shared between processes.
+    That directory is never pruned.
+
+    Entries are keyed by a hash of the graph in dot language, the
+    program, the output format, its extra arguments and the contents
+    of the shape files. A cache is enabled for all the Dot instances
+    by setting Dot.render_cache, or for one of them with
+    Dot.set_render_cache().
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.file_digests = dict()
+        self.lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, data, prog, format, args=(), shape_files=()):
+        """Build the key a rendered graph is stored under."""
+        import hashlib
+
+        key = hashlib.sha256()
+        for value in [prog, format] + list(args):
+            key.update(str(value).encode('utf-8'))
+            key.update(b'\0')
+
+        for path in shape_files:
+            key.update(self.get_file_digest(path))
+
+        key.update(data)
+        return key.hexdigest()
+
+    def get_file_digest(self, path):
+        # The digest of a file is computed again only when it changes.
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+        digest = self.file_digests.get(file_key)
+        if digest is None:
+            import hashlib
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).digest()
+            self.file_digests[file_key] = digest
+
+        return digest
+
+    def get(self, key):
+        """Return the data stored under key, or None if there is none."""
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.entries[key] = data
+                return data
+
+        if self.directory is None:
+            return None
+
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            return None
+
+        self.store(key, data)
+        return data
+
+    def set(self, key, data):
+        """Store data under key."""
+        self.store(key, data)
+
+        if self.directory is not None:
+            # Write to a temporary file first, readers must never see a
+            # partially written entry.
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+            try:
+                getattr(os, 'replace', os.rename)(
+                    tmp_name, os.path.join(self.directory, key))
+            except EnvironmentError:
+                os.unlink(tmp_name)
+
+    def store(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        """Empty the in-memory part of the cache."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class LayoutCache(object):
+    """A cache of layouts, rendering restyled graphs without laying them out.
+
+    The first time a graph is rendered with create() it's also laid out
+    with -Tdot, in the same run, and the positions of its nodes, edges
+    and clusters are kept. Graphs with the same structure, differing
+    only in attributes in 'ignored_attributes', are then rendered with
+    those positions by 'neato -n2', skipping the layout.
+
+    By default the attributes ignored are STYLE_ATTRIBUTES, which
+    include labels: nodes keep their positions when their labels
+    change, but not their sizes. Up to 'max_entries' layouts are kept,
+    evicting the least recently used ones.
+    """
+
+    # The positions kept from a layout, for the graphs, nodes and edges.
+    LAYOUT_ATTRIBUTES = {
+        'graph': ('bb', 'lp'),
+        'node': ('pos',),
+        'edge': ('pos', 'lp', 'head_lp', 'tail_lp', 'xlp'),
+    }
+
+    def __init__(self, max_entries=128, ignored_attributes=None):
+        if ignored_attributes is None:
+            ignored_attributes = STYLE_ATTRIBUTES
+        self.max_entries = max_entries
+        self.ignored_attributes = set(ignored_attributes)
+        self.layouts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_fingerprint(self, graph, prog=None):
+        """Return a hash of the structure of the graph, for its layout.
+
+        'prog' is the program laying it out, graph.prog by default.
+        """
+        import hashlib
+
+        if prog is None:
+            prog = graph.prog
+        structure = repr((prog, self.get_structure(graph.obj_dict)))
+        return hashlib.sha256(structure.encode('utf-8')).hexdigest()
+
+    def get_structure(self, obj_dict):
+        def get_attributes(obj_dict):
+            return sorted(
+                (name, str(value))
+                for name, value in obj_dict['attributes'].items()
+                if name not in self.ignored_attributes)
+
+        nodes = sorted(
+            (name, [get_attributes(node) for node in nodes])
+            for name, nodes in obj_dict['nodes'].items())
+        edges = sorted(
+            (repr(points), [get_attributes(edge) for edge in edges])
+            for points, edges in obj_dict['edges'].items())
+        subgraphs = sorted(
+            (name, [self.get_structure(subgraph) for subgraph in subgraphs])
+            for name, subgraphs in obj_dict['subgraphs'].items())
+
+        return (obj_dict['type'], obj_dict.get('strict'),
+                get_attributes(obj_dict), nodes, edges, subgraphs)
+
+    def get(self, fingerprint):
+        """Return the layout kept for a fingerprint, or None."""
+        with self.lock:
+            layout = self.layouts.pop(fingerprint, None)
+            if layout is not None:
+                self.layouts[fingerprint] = layout
+            return layout
+
+    def set(self, fingerprint, layout):
+        """Keep a layout, as returned by read_layout()."""
+        with self.lock:
+            self.layouts.pop(fingerprint, None)
+            self.layouts[fingerprint] = layout
+            while len(self.layouts) > self.max_entries:
+                self.layouts.popitem(last=False)
+
+    def clear(self):
+        """Forget all the layouts."""
+        with self.lock:
+            self.layouts.clear()
+
+    def create(self, graph, format='ps', prog=None):
+        """Render a Dot instance, reusing the layout of the same structure.
+
+        'prog' is the program laying the graph out the first time,
+        refer to Dot.create(). It can't take command-line arguments.
+        """
+        fingerprint = self.get_fingerprint(graph, prog)
+        layout = self.get(fingerprint)
+
+        if layout is None:
+            outputs = graph.create_multi(['dot', format], prog=prog)
+            self.set(fingerprint, self.read_layout(outputs['dot']))
+            return outputs[format]
+
+        with self.pinned(graph, layout):
+            return graph.create(prog=['neato', '-n2'], format=format)
+
+    def read_layout(self, data):
+        """Collect the positions in the output of -Tdot, by element."""
+        laid_out = graph_from_dot_data(data)
+        layout = {'graphs': dict(), 'nodes': dict(), 'edges': dict()}
+
+        for obj_dict in self.iter_graphs(laid_out.obj_dict):
+            graph_positions = layout['graphs'].setdefault(
+                self.get_key(obj_dict['name'])[0], dict())
+            graph_positions.update(self.get_positions(obj_dict, 'graph'))
+
+            for name, nodes in obj_dict['nodes'].items():
+                if name == 'graph':
+                    # Graph attributes parsed from 'graph [...]' statements.
+                    for node in nodes:
+                        graph_positions.update(
+                            self.get_positions(node, 'graph'))
+                if name in ('graph', 'node', 'edge'):
+                    continue
+                node_positions = layout['nodes'].setdefault(
+                    self.get_key(name)[0], dict())
+                for node in nodes:
+                    node_positions.update(self.get_positions(node, 'node'))
+
+            for points, edges in obj_dict['edges'].items():
+                kept = layout['edges'].setdefault(
+                    tuple(self.get_key(point) for point in points), [])
+                for edge in edges:
+                    kept.append(self.get_positions(edge, 'edge'))
+
+        return layout
+
+    def get_positions(self, obj_dict, kind):
+        attributes = obj_dict['attributes']
+        return dict(
+            (name, attributes[name])
+            for name in self.LAYOUT_ATTRIBUTES[kind] if name in attributes)
+
+    @staticmethod
+    def get_key(point):
+        """Return the name and port of a node, or of an edge end, as keys.
+
+        Graphviz quotes the names it writes only where needed, the
+        quotes are left out of both.
+        """
+        if isinstance(point, (int, long)):
+            return str(point), ''
+        if not isinstance(point, basestring):
+            return point, ''
+
+        match = QUOTED_NAME_RE.match(point)
+        if match is not None:
+            name, port = match.group(0)[1:-1], point[match.end():]
+        else:
+            name, colon, port = point.partition(':')
+            port = colon + port
+        return name, port.replace('"', '')
+
+    @staticmethod
+    def iter_graphs(obj_dict):
+        # The obj_dicts of a graph and all its subgraphs.
+        yield obj_dict
+        for subgraphs in obj_dict['subgraphs'].values():
+            for subgraph in subgraphs:
+                for sub_obj_dict in LayoutCache.iter_graphs(subgraph):
+                    yield sub_obj_dict
+
+    @contextlib.contextmanager
+    def pinned(self, graph, layout):
+        """Set the positions of a layout on a graph while in the context."""
+        changed = []
+        added = []
+        sequence = graph.obj_dict.get('current_child_sequence')
+
+        def pin(attributes, positions):
+            for name, value in positions.items():
+                changed.append((attributes, name, attributes.get(name)))
+                attributes[name] = value
+
+        try:
+            declared = set()
+            for obj_dict in self.iter_graphs(graph.obj_dict):
+                pin(obj_dict['attributes'], layout['graphs'].get(
+                    self.get_key(obj_dict['name'])[0], dict()))
+
+                for name, nodes in obj_dict['nodes'].items():
+                    name = self.get_key(name)[0]
+                    declared.add(name)
+                    for node in nodes:
+                        pin(node['attributes'],
+                            layout['nodes'].get(name, dict()))
+
+                for points, edges in obj_dict['edges'].items():
+                    positions = layout['edges'].get(
+                        tuple(self.get_key(point) for point in points), [])
+                    for edge, edge_positions in zip(edges, positions):
+                        pin(edge['attributes'], edge_positions)
+
+            # Nodes only named by edges get a statement of their own.
+            for name, positions in layout['nodes'].items():
+                if name not in declared:
+                    if needs_quotes(name) or ':' in name:
+                        name = '"%s"' % name
+                    node = Node(name, **positions)
+                    graph.add_node(node)
+                    added.append(node)
+
+            yield graph
+        finally:
+            for node in added:
+                graph.del_node(node)
+            if sequence is not None:
+                graph.obj_dict['current_child_sequence'] = sequence
+            for attributes, name, value in reversed(changed):
+                if value is None:
+                    attributes.pop(name, None)
+                else:
+                    attributes[name] = value
+
+
+class TileRenderer(object):
+    """Renders a graph as map tiles, laying it out only once.
+
+    At zoom level 'z' the graph is cut in 2**z by 2**z square tiles of
+    'tile_size' pixels, the whole graph fitting in the tile of level 0.
+    Each tile is drawn by 'neato -n2' from a graph holding only the
+    elements within 'margin' points of it, at the positions computed
+    by 'prog', and clipped with the 'viewport' attribute.
+
+    Tiles are written in 'format' to 'directory' as 'key/z/x/y.format',
+    x counting from the left and y from the top like the tiles of web
+    maps. 'key' is a hash of the graph and the rendering options, the
+    layout and the tiles already rendered for a key are reused. Tiles
+    with nothing in them aren't rendered.
+    """
+
+    # Graph attributes setting the size of the drawing, left out of tiles.
+    SIZE_ATTRIBUTES = set([
+        'size', 'ratio', 'page', 'viewport', 'dpi', 'resolution', 'pad',
+        'margin', 'rotate', 'landscape'])
+
+    # The members of the json0 objects which aren't attributes.
+    JSON_MEMBERS = set([
+        '_gvid', '_subgraph_cnt', 'name', 'directed', 'strict', 'objects',
+        'edges', 'nodes', 'subgraphs', 'tail', 'head'])
+
+    def __init__(self, graph, directory, tile_size=256, format='png',
+                 prog=None, margin=18):
+        import hashlib
+
+        self.graph = graph
+        self.tile_size = tile_size
+        self.format = format
+        self.prog = prog
+        self.margin = margin
+
+        key = hashlib.sha256()
+        for value in (prog, format, tile_size, margin):
+            key.update(str(value).encode('utf-8'))
+            key.update(b'\0')
+        key.update(graph._to_bytes())
+        self.key = key.hexdigest()
+        self.directory = os.path.join(directory, self.key)
+
+        self.laid_out = None
+        self.index = None
+
+    def lay_out(self):
+        """Lay the graph out, unless it has already been."""
+        if self.index is not None:
+            return
+
+        import json
+
+        from pydot_ng import _layout
+
+        path = os.path.join(self.directory, 'layout.json')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            data = self.graph.create(prog=self.prog, format='json0')
+            self.write(path, data)
+
+        self.laid_out = json.loads(data.decode('utf-8'))
+        layout = _layout.read_json(self.laid_out)
+        self.index = layout.get_spatial_index()
+
+        bb = self.laid_out.get('bb', '0,0,0,0')
+        self.bb = [float(value) for value in bb.split(',')]
+        self.side = max(self.bb[2] - self.bb[0], self.bb[3] - self.bb[1], 1)
+
+    def get_tile_box(self, zoom, x, y):
+        """Return the area of a tile in the layout, as (x0, y0, x1, y1)."""
+        self.lay_out()
+        side = self.side / 2 ** zoom
+        left = self.bb[0] + x * side
+        top = self.bb[3] - y * side
+        return left, top - side, left + side, top
+
+    def get_tile_path(self, zoom, x, y):
+        return os.path.join(
+            self.directory, str(zoom), str(x),
+            '%d.%s' % (y, get_output_suffix(self.format)))
+
+    def get_attributes(self, obj):
+        attributes = dict()
+        for name, value in obj.items():
+            if name in self.JSON_MEMBERS:
+                continue
+            value = quote_if_necessary(value)
+            # Lists of numbers such as positions pass for IDs, they
+            # are quoted so the commas don't split them.
+            if isinstance(value, basestring) and ',' in value and \
+                    value[:1] not in ('"', '<'):
+                value = '"%s"' % value
+            attributes[name] = value
+        return attributes
+
+    def get_tile_graph(self, zoom, x, y):
+        """Return a Dot instance drawing a tile, or None if it's empty."""
+        x0, y0, x1, y1 = self.get_tile_box(zoom, x, y)
+        area = (x0 - self.margin, y0 - self.margin,
+                x1 + self.margin, y1 + self.margin)
+
+        nodes = set(self.index.nodes_in(*area))
+        edges = self.index.edges_in(*area)
+        if not nodes and not edges:
+            return None
+
+        laid_out = self.laid_out
+        layout = self.index.layout
+        objects = laid_out.get('objects', [])
+        subgraph_count = laid_out.get('_subgraph_cnt', 0)
+
+        attributes = dict(
+            (name, value)
+            for name, value in self.get_attributes(laid_out).items()
+            if name not in self.SIZE_ATTRIBUTES)
+        attributes['dpi'] = 72
+        attributes['pad'] = 0
+        attributes['viewport'] = '"%d,%d,%r,%r,%r"' % (
+            self.tile_size, self.tile_size, self.tile_size / (x1 - x0),
+            (x0 + x1) / 2, (y0 + y1) / 2)
+
+        tile = Dot(
+            laid_out.get('name', 'G'),
+            graph_type=laid_out.get('directed') and 'digraph' or 'graph',
+            strict=laid_out.get('strict', False), **attributes)
+        for name in ('progs', 'shape_files', 'render_cache', 'timeout',
+                     'cpu_time', 'address_space', 'instrumentation_hooks'):
+            setattr(tile, name, getattr(self.graph, name))
+
+        # The defaults of the graph itself aren't in the layout.
+        for name in ('node', 'edge'):
+            for defaults in self.graph.obj_dict['nodes'].get(name, []):
+                tile.add_node(Node(name, **defaults['attributes']))
+
+        for obj in objects[:subgraph_count]:
+            if not obj['name'].startswith('cluster') or 'bb' not in obj:
+                continue
+            cx0, cy0, cx1, cy1 = [float(v) for v in obj['bb'].split(',')]
+            if cx0 <= area[2] and area[0] <= cx1 and \
+                    cy0 <= area[3] and area[1] <= cy1:
+                tile.add_subgraph(Subgraph(
+                    quote_if_necessary(obj['name']),
+                    **self.get_attributes(obj)))
+
+        # Edges need both their ends placed.
+        for j in edges:
+            nodes.add(layout.edge_tail[j])
+            nodes.add(layout.edge_head[j])
+
+        for i in sorted(nodes):
+            obj = objects[subgraph_count + i]
+            tile.add_node(Node(
+                quote_if_necessary(obj['name']), **self.get_attributes(obj)))
+
+        for j in edges:
+            tile.add_edge(Edge(
+                quote_if_necessary(layout.names[layout.edge_tail[j]]),
+                quote_if_necessary(layout.names[layout.edge_head[j]]),
+                **self.get_attributes(laid_out['edges'][j])))
+
+        return tile
+
+    def render(self, zoom_levels=(0, 1, 2), max_workers=None):
+        """Render the tiles of the zoom levels which are missing.
+
+        The tiles are rendered concurrently, refer to render_many() for
+        'max_workers'. Returns the paths of all the tiles of the levels,
+        leaving out the empty ones.
+        """
+        self.lay_out()
+
+        tiles = [
+            (zoom, x, y) for zoom in zoom_levels
+            for x in range(2 ** zoom) for y in range(2 ** zoom)]
+        missing = [
+            tile for tile in tiles
+            if not os.path.exists(self.get_tile_path(*tile))]
+
+        # The paths of the tiles rendered, the empty ones are left out.
+        rendered = []
+
+        def get_graphs():
+            for tile in missing:
+                graph = self.get_tile_graph(*tile)
+                if graph is not None:
+                    rendered.append(self.get_tile_path(*tile))
+                    yield graph
+
+        for result in render_many(
+                get_graphs(), self.format, ['neato', '-n2'], max_workers,
+                ordered=False):
+            if result.error is not None:
+                raise result.error
+            self.write(rendered[result.index], result.data)
+
+        paths = [self.get_tile_path(*tile) for tile in tiles]
+        return [path for path in paths if os.path.exists(path)]
+
+    @staticmethod
+    def write(path, data):
+        # Written to a temporary file first, readers must never see a
+        # partially written file.
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except EnvironmentError:
+                if not os.path.isdir(directory):
+                    raise
+
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=directory)
+        with os.fdopen(tmp_fd, 'wb') as f:
+            f.write(data)
+        try:
+            getattr(os, 'replace', os.rename)(tmp_name, path)
+        except EnvironmentError:
+            os.unlink(tmp_name)
+            raise
+
+
+class ShapeFileStage(object):
+    """Working directories holding the shape files of graphs.
+
+    Graphviz looks for shape files in its working directory. A directory
+    linking to them is made the first time a set of shape files is
+    rendered and reused while the files don't change, even by graphs
+    rendered at the same time. Up to 'max_dirs' unused directories are
+    kept, all of them are removed when the process exits.
+
+    The files are hard linked, or symlinked where that's not possible,
+    and copied only as a last resort.
+    """
+
+    def __init__(self, max_dirs=32):
+        self.max_dirs = max_dirs
+        self.dirs = collections.OrderedDict()
+        self.keys = dict()
+        self.users = dict()
+        self.lock = threading.Lock()
+        atexit.register(self.clear)
+
+    def acquire(self, shape_files):
+        """Return a directory with the shape files, to release() later."""
+        key = []
+        for path in shape_files:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            key.append((path, stat.st_mtime, stat.st_size))
+        key = tuple(key)
+
+        with self.lock:
+            directory = self.dirs.pop(key, None)
+            if directory is not None:
+                self.dirs[key] = directory
+                self.users[directory] += 1
+                return directory
+
+        directory = tempfile.mkdtemp(prefix='pydot_ng-')
+        try:
+            for path, _mtime, _size in key:
+                self.link(path, os.path.join(
+                    directory, os.path.basename(path)))
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        with self.lock:
+            if key in self.dirs:
+                # Staged by another thread meanwhile, use theirs.
+                shutil.rmtree(directory, ignore_errors=True)
+                directory = self.dirs[key]
+            else:
+                self.dirs[key] = directory
+                self.keys[directory] = key
+                self.users[directory] = 0
+            self.users[directory] += 1
+
+        return directory
+
+    @staticmethod
+    def link(source, destination):
+        if os.path.lexists(destination):
+            os.unlink(destination)
+
+        for make_link in (getattr(os, 'link', None),
+                          getattr(os, 'symlink', None)):
+            if make_link is None:
+                continue
+            try:
+                make_link(source, destination)
+                return
+            except (EnvironmentError, NotImplementedError):
+                pass
+
+        shutil.copyfile(source, destination)
+
+    def release(self, directory):
+        """Tell a directory from acquire() is no longer used."""
+        with self.lock:
+            self.users[directory] -= 1
+            self.prune(self.max_dirs)
+
+    def prune(self, max_dirs):
+        # Removes the oldest unused directories over max_dirs, the lock
+        # must be held.
+        unused = [key for key, directory in self.dirs.items()
+                  if not self.users[directory]]
+        for key in unused[:max(len(unused) - max_dirs, 0)]:
+            directory = self.dirs.pop(key)
+            del self.keys[directory]
+            del self.users[directory]
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def clear(self):
+        """Remove all the unused directories."""
+        with self.lock:
+            self.prune(0)
+
+
+class RenderStream(object):
+    """The output of a GraphViz program, read while the program runs.
+
+    Returned by Dot.create(..., stream=True). It's a read-only file-like
+    object, which must be closed once read. Closing it waits for the
+    program and raises InvocationException if it failed. Closing it
+    before reading all of it stops the program instead.
+
+    The output is stored in the render cache once read, unless it's
+    bigger than the cache holds.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.exhausted = False
+        self.closed = False
+        self.stderr_chunks = []
+
+        # The output kept for the render cache, None once it can't be.
+        self.chunks = None
+        if job['cache'] is not None and job['key'] is not None:
+            self.chunks = []
+
+        hooks = job['hooks']
+        self.work_dir = Dot._stage_shape_files(job)
+        try:
+            if hooks:
+                start = default_timer()
+            self.process = subprocess.Popen(
+                job['cmdline'],
+                cwd=self.work_dir,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                **get_popen_limits(job['limits']))
+        except Exception:
+            Dot._unstage_shape_files(job, self.work_dir)
+            raise
+
+        self.stdout_bytes = 0
+        self.watchdog = Watchdog(self.process, job['limits']['timeout'])
+        try:
+            with reap_on_error(self.process):
+                if hooks:
+                    notify_hooks(hooks, 'create.spawn', start)
+                    self.start = default_timer()
+
+                self.watchdog.start()
+
+                # The graph is written and stderr read by threads of their
+                # own, the program blocks if any of its pipes is left full.
+                self.threads = [
+                    threading.Thread(target=self.feed),
+                    threading.Thread(target=self.drain)]
+                for thread in self.threads:
+                    thread.daemon = True
+                    thread.start()
+        except BaseException:
+            self.watchdog.cancel()
+            Dot._unstage_shape_files(job, self.work_dir)
+            raise
+
+    def feed(self):
+        try:
+            self.process.stdin.write(self.job['data'])
+        except EnvironmentError:
+            # The program exited early, reported when closing.
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except EnvironmentError:
+                pass
+
+    def drain(self):
+        self.stderr_chunks.append(self.process.stderr.read())
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if size is None or size < 0 or not data:
+            self.exhausted = True
+        self.stdout_bytes += len(data)
+
+        if self.chunks is not None:
+            if self.stdout_bytes > self.job['cache'].max_bytes:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+        return data
+
+    def __iter__(self):
+        return iter(functools.partial(self.read, STREAM_CHUNK_SIZE), b'')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            if not self.exhausted and self.process.poll() is None:
+                kill_process(self.process)
+            self.process.stdout.close()
+            status = self.process.wait()
+            self.watchdog.cancel()
+            for thread in self.threads:
+                thread.join()
+            self.process.stderr.close()
+        finally:
+            Dot._unstage_shape_files(self.job, self.work_dir)
+
+        stderr_output = NULL_SEP.join(self.stderr_chunks)
+        if self.job['hooks']:
+            notify_hooks(
+                self.job['hooks'], 'create.run', self.start, status=status,
+                stdout_bytes=self.stdout_bytes,
+                stderr_bytes=len(stderr_output))
+        if self.watchdog.fired:
+            Dot._raise_timeout(self.job, stderr_output)
+        if self.exhausted:
+            output = None
+            if self.chunks is not None:
+                output = NULL_SEP.join(self.chunks)
+            Dot._finish_create(self.job, status, output, stderr_output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProgPolicy(object):
+    """Chooses the GraphViz program laying a graph out, for prog='auto'.
+
+    choose() picks it from the statistics of the graph returned by
+    dot_stats(). Graphs with clusters and directed graphs of up to
+    'dot_edges' edges go to dot, which cuts its costlier passes short
+    on those of up to 'tuned_dot_edges' edges. Bigger graphs with
+    clusters go to fdp, which draws clusters too. Undirected graphs of
+    up to 'neato_nodes' nodes go to neato. Graphs with more than
+    'max_density' edges per node go past these limits. Everything
+    else goes to 'fallback'. Subclasses can override choose().
+
+    If 'time_budget' is set, the chosen program gets that many seconds
+    before create() runs 'fallback' in its place.
+    """
+
+    def __init__(self, dot_edges=2000, tuned_dot_edges=20000,
+                 neato_nodes=1000, max_density=10, time_budget=None,
+                 fallback=('sfdp', '-Goverlap=prism')):
+        self.dot_edges = dot_edges
+        self.tuned_dot_edges = tuned_dot_edges
+        self.neato_nodes = neato_nodes
+        self.max_density = max_density
+        self.time_budget = time_budget
+        self.fallback = fallback
+
+    def choose(self, stats):
+        """Return the program, and its arguments, for the stats of a graph.
+
+        The result is a program name or a list, as taken by create().
+        """
+        nodes, edges = stats['nodes'], stats['edges']
+        sparse = edges <= self.max_density * max(nodes, 1)
+
+        if stats['clusters'] or stats['graph_type'] == 'digraph':
+            if edges <= self.dot_edges and sparse:
+                return 'dot'
+            if edges <= self.tuned_dot_edges and sparse:
+                return ['dot', '-Gnslimit=2', '-Gnslimit1=2',
+                        '-Gmclimit=0.5']
+            # Of the other programs only fdp draws clusters, neato and
+            # sfdp leave them out.
+            if stats['clusters']:
+                return 'fdp'
+
+        elif nodes <= self.neato_nodes and sparse:
+            return 'neato'
+
+        return list(self.fallback)
+
+    def get_fallback(self, prog):
+        """Return the program replacing 'prog' when it takes too long.
+
+        None is returned if 'prog' is the fallback itself.
+        """
+        if prog == self.fallback[0]:
+            return None
+        return list(self.fallback)
 
 
 class Dot(Graph):
@@ -1642,42 +3037,40 @@ class Dot(Graph):
     the base class 'Graph'.
     """
 
+    # The RenderCache used by create(), if any.
+    render_cache = None
+
+    # Where create() puts the shape files for Graphviz to find them.
+    shape_file_stage = ShapeFileStage()
+
+    # The instrumentation hooks of this graph only, refer to
+    # add_instrumentation_hook().
+    instrumentation_hooks = ()
+
+    # What chooses the program when it's 'auto', see set_prog_policy().
+    prog_policy = ProgPolicy()
+
+    # The default limits of the GraphViz programs, refer to set_limits().
+    timeout = None
+    cpu_time = None
+    address_space = None
+
+    # The formats a create_'format' and write_'format' method is defined
+    # for, see add_format_methods().
+    formats = [
+        'canon', 'cmap', 'cmapx', 'cmapx_np', 'dia', 'dot',
+        'fig', 'gd', 'gd2', 'gif', 'hpgl', 'imap', 'imap_np', 'ismap',
+        'jpe', 'jpeg', 'jpg', 'mif', 'mp', 'pcl', 'pdf', 'pic', 'plain',
+        'plain-ext', 'png', 'ps', 'ps2', 'svg', 'svgz', 'vml', 'vmlz',
+        'vrml', 'vtx', 'wbmp', 'xdot', 'xlib']
+
     def __init__(self, *argsl, **argsd):
         Graph.__init__(self, *argsl, **argsd)
 
         self.shape_files = list()
         self.progs = None
-        self.formats = [
-            'canon', 'cmap', 'cmapx', 'cmapx_np', 'dia', 'dot',
-            'fig', 'gd', 'gd2', 'gif', 'hpgl', 'imap', 'imap_np', 'ismap',
-            'jpe', 'jpeg', 'jpg', 'mif', 'mp', 'pcl', 'pdf', 'pic', 'plain',
-            'plain-ext', 'png', 'ps', 'ps2', 'svg', 'svgz', 'vml', 'vmlz',
-            'vrml', 'vtx', 'wbmp', 'xdot', 'xlib']
         self.prog = 'dot'
 
-        # Automatically creates all the methods enabling the creation
-        # of output in any of the supported formats.
-        for frmt in self.formats:
-            self.__setattr__(
-                'create_' + frmt,
-                lambda f=frmt, prog=self.prog:
-                self.create(format=f, prog=prog))
-            f = self.__dict__['create_' + frmt]
-            f.__doc__ = (
-                '''Refer to the docstring accompanying the'''
-                ''''create' method for more information.''')
-
-        for frmt in self.formats + ['raw']:
-            self.__setattr__(
-                'write_' + frmt,
-                lambda path, f=frmt, prog=self.prog: self.write(path, format=f,
-                                                                prog=prog))
-
-            f = self.__dict__['write_' + frmt]
-            f.__doc__ = (
-                '''Refer to the docstring accompanying the'''
-                ''''write' method for more information.''')
-
     def __getstate__(self):
         return copy.copy(self.obj_dict)
 
@@ -1711,6 +3104,52 @@ class Dot(Graph):
         """
         self.prog = prog
 
+    def set_prog_policy(self, policy):
+        """Sets the ProgPolicy choosing the program when it's 'auto'.
+
+        With the program set to 'auto', by set_prog() or in the calls
+        to create(), it's chosen from the structure of the graph. The
+        policy is shared by all the Dot instances unless set for one
+        of them with this method.
+        """
+        self.prog_policy = policy
+
+    def set_limits(self, timeout=None, cpu_time=None, address_space=None):
+        """Sets the default limits of the GraphViz programs.
+
+        'timeout' is how many seconds a program may run before it's
+        killed, along with its children, and InvocationTimeout raised.
+        'cpu_time', in seconds, and 'address_space', in bytes, limit the
+        resources it may use, they are only supported on POSIX systems.
+        None means no limit. They can be overridden in each call to
+        create().
+        """
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.address_space = address_space
+
+    def add_instrumentation_hook(self, hook):
+        """Register an instrumentation hook for this graph only.
+
+        Refer to the add_instrumentation_hook() function.
+        """
+        self.instrumentation_hooks = (
+            list(self.instrumentation_hooks) + [hook])
+
+    def remove_instrumentation_hook(self, hook):
+        """Unregister a hook registered with add_instrumentation_hook()."""
+        hooks = list(self.instrumentation_hooks)
+        hooks.remove(hook)
+        self.instrumentation_hooks = hooks
+
+    def set_render_cache(self, cache):
+        """Sets the RenderCache used to store the rendered graph.
+
+        Setting it to None disables caching for this graph, unless
+        a cache is set for all graphs in Dot.render_cache.
+        """
+        self.render_cache = cache
+
     def set_graphviz_executables(self, paths):
         """Manually specify the location of the GraphViz executables.
 
@@ -1725,7 +3164,30 @@ class Dot(Graph):
 
         self.progs = paths
 
-    def write(self, path, prog=None, format='raw'):
+    def get_supported_formats(self, prog=None):
+        """Returns the output formats supported by the GraphViz program.
+
+        The program, self.prog by default, is asked which formats it
+        supports the first time, see probe_graphviz(). If it can't be
+        found or asked, the list in self.formats is returned.
+        """
+        if prog is None:
+            prog = self.prog
+
+        progs = self.progs
+        if progs is None:
+            progs = find_graphviz() or dict()
+
+        capabilities = None
+        if prog in progs:
+            capabilities = probe_graphviz(progs[prog])
+
+        if not capabilities or not capabilities['formats']:
+            return list(self.formats)
+        return capabilities['formats']
+
+    def write(self, path, prog=None, format='raw', timeout=None,
+              cpu_time=None, address_space=None):
         """Write graph to file in selected format.
 
         Given a filename 'path' it will open/create and truncate
@@ -1748,49 +3210,63 @@ class Dot(Graph):
         which are automatically defined for all the supported formats.
         [write_ps(), write_gif(), write_dia(), ...]
 
+        'timeout', 'cpu_time' and 'address_space' limit the program,
+        as they do for create().
         """
         if prog is None:
             prog = self.prog
+        limits = dict(timeout=timeout, cpu_time=cpu_time,
+                      address_space=address_space)
 
-        fobj, close = get_fobj(path, 'w+b')
-        try:
+        with open_output(path) as fobj:
             if format == 'raw':
-                data = self.to_string()
-                if isinstance(data, basestring):
-                    if not isinstance(data, unicode):
-                        try:
-                            data = unicode(data, 'utf-8')
-                        except Exception:
-                            pass
+                fobj.write(self._to_bytes())
+
+            elif prog == 'auto' and self.prog_policy.time_budget is not None:
+                # Streams don't fall back to another program.
+                fobj.write(self.create(prog, format, **limits))
+
+            else:
+                # The output is copied as it comes, it's never all
+                # held in memory.
+                with self.create(prog, format, stream=True,
+                                 **limits) as stream:
+                    shutil.copyfileobj(stream, fobj, STREAM_CHUNK_SIZE)
+
+        return True
 
+    def _to_bytes(self):
+        """Return the graph in dot language, encoded with its charset."""
+        data = self.to_string()
+        if isinstance(data, basestring):
+            if not isinstance(data, unicode):
                 try:
-                    charset = self.get_charset()
-                    if not PY3 or not charset:
-                        charset = 'utf-8'
-                    data = data.encode(charset)
+                    data = unicode(data, 'utf-8')
                 except Exception:
-                    if PY3:
-                        data = data.encode('utf-8')
                     pass
 
-                fobj.write(data)
-
-            else:
-                fobj.write(self.create(prog, format))
-        finally:
-            if close:
-                fobj.close()
+        try:
+            charset = self.get_charset()
+            if not PY3 or not charset:
+                charset = 'utf-8'
+            data = data.encode(charset)
+        except Exception:
+            if PY3:
+                data = data.encode('utf-8')
+            pass
 
-        return True
+        return data
 
-    def create(self, prog=None, format='ps'):
+    def create(self, prog=None, format='ps', backend='subprocess',
+               stream=False, timeout=None, cpu_time=None,
+               address_space=None):
         """Creates and returns a Postscript representation of the graph.
 
-        create will write the graph to a temporary dot file and process
-        it with the program given by 'prog' (which defaults to 'twopi'),
-        reading the Postscript output and returning it as a string is the
-        operation is successful.
-        On failure None is returned.
+        create will pipe the graph in dot language to the program given
+        by 'prog' (which defaults to 'dot'), reading the Postscript
+        output and returning it as a string if the operation is
+        successful.
+        On failure an InvocationException is raised.
 
         There's also the preferred possibility of using:
 
@@ -1804,15 +3280,124 @@ class Dot(Graph):
         arguments for it:
 
             ['twopi', '-Tdot', '-s10']
-        """
 
+        With backend='libgvc' the graph is rendered in this process
+        through the GraphViz libraries, loaded with ctypes, instead of
+        running a program. It falls back to running the program when
+        the libraries can't be found, and for graphs with shape files
+        or command-line arguments, which the libraries don't take.
+
+        If 'stream' is True a RenderStream is returned instead, to read
+        the output while the program produces it, without holding all
+        of it in memory. Streamed outputs are only stored in the render
+        cache if they fit in it.
+
+        'timeout', 'cpu_time' and 'address_space' limit the program,
+        overriding the defaults from set_limits().
+
+        With prog='auto' the program is chosen by the ProgPolicy set
+        with set_prog_policy(). If the policy has a time budget and the
+        program runs out of it, the policy's fallback is run instead,
+        given what is left of the timeout. Streams don't fall back.
+        """
         if prog is None:
             prog = self.prog
+        budget = self.prog_policy.time_budget
+        if timeout is None:
+            timeout = self.timeout
+
+        if (prog == 'auto' and not stream and budget is not None and
+                (timeout is None or budget < timeout)):
+            job = self._prepare_create(
+                prog, format, backend, timeout=budget, cpu_time=cpu_time,
+                address_space=address_space)
+            try:
+                return self._run_create(job)
+            except InvocationTimeout:
+                prog = self.prog_policy.get_fallback(job['prog'])
+                if prog is None:
+                    raise
+            if timeout is not None:
+                timeout -= budget
+
+        job = self._prepare_create(
+            prog, format, backend, timeout=timeout, cpu_time=cpu_time,
+            address_space=address_space)
+        if stream:
+            if 'cmdline' not in job:
+                return io.BytesIO(self._run_create(job))
+            return RenderStream(job)
+        return self._run_create(job)
+
+    def _prepare_create(self, prog, format, backend='subprocess',
+                        **limits):
+        # The part of create() which must run in the calling thread:
+        # serializing the graph, looking it up in the render cache and
+        # finding the executable. It returns what _run_create() needs,
+        # which then touches nothing else in the graph. Without a format
+        # the cache isn't looked up and the command line has no -T.
+        if prog is None:
+            prog = self.prog
+
+        hooks = None
+        if INSTRUMENTATION_HOOKS or self.instrumentation_hooks:
+            hooks = INSTRUMENTATION_HOOKS + list(self.instrumentation_hooks)
+            start = default_timer()
+
+        job = {
+            'data': self._to_bytes(),
+            'hooks': hooks,
+            'shape_files': list(self.shape_files),
+            'shape_file_stage': self.shape_file_stage,
+            'cache': self.render_cache,
+            'limits': dict(
+                (name, getattr(self, name) if limits.get(name) is None
+                 else limits[name])
+                for name in ('timeout', 'cpu_time', 'address_space')),
+            'key': None,
+            'output': None,
+        }
+
+        if hooks:
+            notify_hooks(
+                hooks, 'create.serialize', start, bytes=len(job['data']))
+
+        if prog == 'auto':
+            prog = self.prog_policy.choose(dot_stats(job['data']))
 
         if isinstance(prog, (list, tuple)):
-            prog, args = prog[0], prog[1:]
+            prog, args = prog[0], list(prog[1:])
         else:
             args = []
+        job['prog'] = prog
+        job['args'] = args
+
+        cache = job['cache']
+        if cache is not None and format is not None:
+            if hooks:
+                start = default_timer()
+            job['key'] = cache.get_key(
+                job['data'], prog, format, args, job['shape_files'])
+            job['output'] = cache.get(job['key'])
+            if hooks:
+                notify_hooks(hooks, 'create.cache', start,
+                             hit=job['output'] is not None)
+            if job['output'] is not None:
+                return job
+
+        if backend == 'libgvc':
+            from pydot_ng import _gvc
+            limited = any(
+                value is not None for value in job['limits'].values())
+            if (not args and not job['shape_files'] and not limited and
+                    _gvc.available()):
+                job['render'] = functools.partial(_gvc.render, prog=prog,
+                                                  format=format)
+                return job
+        elif backend != 'subprocess':
+            raise Error(
+                'Invalid backend "%s". Accepted backends are: '
+                'subprocess, libgvc' % backend)
 
         if self.progs is None:
             self.progs = find_graphviz()
@@ -1830,73 +3415,737 @@ class Dot(Graph):
                 'GraphViz\'s executable "%s" is not a file or doesn\'t exist'
                 % self.progs[prog])
 
-        tmp_fd, tmp_name = tempfile.mkstemp()
-        os.close(tmp_fd)
-        self.write(tmp_name)
-        tmp_dir = os.path.dirname(tmp_name)
+        job['cmdline'] = [self.progs[prog]] + args
+        if format is not None:
+            job['cmdline'].insert(1, '-T' + format)
+        return job
+
+    @staticmethod
+    def _run_create(job):
+        if job['output'] is not None:
+            return job['output']
+
+        hooks = job['hooks']
+
+        if 'render' in job:
+            if hooks:
+                start = default_timer()
+            output = job['render'](job['data'])
+            if hooks:
+                notify_hooks(hooks, 'create.render', start, bytes=len(output))
+            if job['cache'] is not None:
+                job['cache'].set(job['key'], output)
+            return output
+
+        work_dir = Dot._stage_shape_files(job)
+        try:
+            if hooks:
+                start = default_timer()
+            p = subprocess.Popen(
+                job['cmdline'],
+                cwd=work_dir,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                **get_popen_limits(job['limits']))
+            with reap_on_error(p):
+                if hooks:
+                    notify_hooks(hooks, 'create.spawn', start)
+                    start = default_timer()
+
+                # communicate() reads stdout and stderr at the same time,
+                # a process filling the stderr pipe can't block it.
+                with Watchdog(p, job['limits']['timeout']) as watchdog:
+                    stdout_output, stderr_output = p.communicate(
+                        job['data'])
+            if hooks:
+                notify_hooks(
+                    hooks, 'create.run', start, status=p.returncode,
+                    stdout_bytes=len(stdout_output),
+                    stderr_bytes=len(stderr_output))
+        finally:
+            Dot._unstage_shape_files(job, work_dir)
+
+        if watchdog.fired:
+            Dot._raise_timeout(job, stderr_output)
+
+        return Dot._finish_create(
+            job, p.returncode, stdout_output, stderr_output)
+
+    @staticmethod
+    def _stage_shape_files(job):
+        # Graphviz looks for the shape files in its working directory, one
+        # is only needed when there are any.
+        if not job['shape_files']:
+            return None
+
+        hooks = job['hooks']
+        if hooks:
+            start = default_timer()
+        directory = job['shape_file_stage'].acquire(job['shape_files'])
+        if hooks:
+            notify_hooks(hooks, 'create.stage', start,
+                         files=len(job['shape_files']))
+        return directory
+
+    @staticmethod
+    def _unstage_shape_files(job, directory):
+        if directory is None:
+            return
+
+        hooks = job['hooks']
+        if hooks:
+            start = default_timer()
+        job['shape_file_stage'].release(directory)
+        if hooks:
+            notify_hooks(hooks, 'create.cleanup', start)
+
+    @staticmethod
+    def _raise_timeout(job, stderr_output):
+        stderr_output = decode_stderr(stderr_output)
+        raise InvocationTimeout(
+            'Program timed out after %s seconds. stderr follows: %s' % (
+                job['limits']['timeout'], stderr_output), stderr_output)
+
+    @staticmethod
+    def _finish_create(job, status, stdout_output, stderr_output):
+        stderr_output = decode_stderr(stderr_output)
 
-        # For each of the image files...
-        for img in self.shape_files:
+        if status != 0:
+            raise InvocationException(
+                'Program terminated with status: %d. stderr follows: %s' % (
+                    status, stderr_output))
+        elif stderr_output:
+            print(stderr_output)
 
-            # Get its data
-            f = open(img, 'rb')
-            f_data = f.read()
-            f.close()
+        if job['cache'] is not None and stdout_output is not None:
+            job['cache'].set(job['key'], stdout_output)
 
-            # And copy it under a file with the same name in the
-            # temporary directory
-            f = open(os.path.join(tmp_dir, os.path.basename(img)), 'wb')
-            f.write(f_data)
-            f.close()
+        return stdout_output
 
-        cmdline = [self.progs[prog], '-T' + format, tmp_name] + args
+    def create_multi(self, formats, prog=None, timeout=None, cpu_time=None,
+                     address_space=None):
+        """Creates the graph in several formats, laying it out only once.
 
-        p = subprocess.Popen(
-            cmdline,
-            cwd=tmp_dir,
-            stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        The program is run once with a -T option for each of the
+        'formats', and a dictionary from each format to its output is
+        returned. Refer to create() for the other arguments.
+        """
+        formats = list(collections.OrderedDict.fromkeys(formats))
+        job = self._prepare_create(
+            prog, None, timeout=timeout, cpu_time=cpu_time,
+            address_space=address_space)
+
+        outputs = dict()
+        keys = dict()
+        cache = job['cache']
+        if cache is not None:
+            for frmt in formats:
+                keys[frmt] = cache.get_key(
+                    job['data'], job['prog'], frmt, job['args'],
+                    job['shape_files'])
+                output = cache.get(keys[frmt])
+                if output is not None:
+                    outputs[frmt] = output
+
+        missing = [frmt for frmt in formats if frmt not in outputs]
+        if not missing:
+            return outputs
+
+        cmdline = (job['cmdline'][:1] + ['-T' + frmt for frmt in missing] +
+                   job['cmdline'][1:])
+
+        # With -O each output is written next to the input, named after it.
+        tmp_dir = tempfile.mkdtemp()
+        work_dir = None
+        try:
+            input_path = os.path.join(tmp_dir, 'graph.gv')
+            with open(input_path, 'wb') as f:
+                f.write(job['data'])
+
+            work_dir = Dot._stage_shape_files(job)
+            p = subprocess.Popen(
+                cmdline + ['-O', input_path],
+                cwd=work_dir or tmp_dir,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                **get_popen_limits(job['limits']))
+            with reap_on_error(p):
+                with Watchdog(p, job['limits']['timeout']) as watchdog:
+                    stdout_output, stderr_output = p.communicate()
+
+            if watchdog.fired:
+                Dot._raise_timeout(job, stderr_output)
+            Dot._finish_create(job, p.returncode, None, stderr_output)
+
+            for frmt in missing:
+                output_path = input_path + '.' + get_output_suffix(frmt)
+                try:
+                    with open(output_path, 'rb') as f:
+                        outputs[frmt] = f.read()
+                except EnvironmentError:
+                    raise InvocationException(
+                        'Program produced no output in format "%s"' % frmt)
+
+                if cache is not None:
+                    cache.set(keys[frmt], outputs[frmt])
+        finally:
+            Dot._unstage_shape_files(job, work_dir)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return outputs
+
+    def create_layout(self, prog=None, format='plain', **kwargs):
+        """Lays the graph out and returns the positions as a Layout.
+
+        The output of the program in 'format', which can be 'plain',
+        'plain-ext', 'json' or 'json0', is read into arrays of node and
+        edge positions, in points, without creating any Node or Edge.
+        Its get_spatial_index() method indexes them for hit-testing.
+        The other arguments are passed on to create().
+        """
+        from pydot_ng import _layout
+        return _layout.parse_layout(
+            self.create(prog=prog, format=format, **kwargs), format)
+
+    def create_packed(self, prog=None, format='ps', max_workers=None,
+                      margin=8):
+        """Lays the connected components out apart and renders them packed.
+
+        Each component found by get_components() is laid out by 'prog'
+        on its own, running up to 'max_workers' programs at the same
+        time, refer to render_many(). The layouts are packed by
+        pack_layouts(), 'margin' points apart, and the graph is rendered
+        in 'format' at those positions by 'neato -n2'. Graphs of a single
+        component are rendered by create().
+        """
+        components = get_components(self)
+        if len(components) < 2:
+            return self.create(prog=prog, format=format)
+
+        reader = LayoutCache()
+        layouts = []
+        for result in render_many(components, 'dot', prog, max_workers):
+            if result.error is not None:
+                raise result.error
+            layouts.append(reader.read_layout(result.data))
+
+        name = LayoutCache.get_key(self.get_name())[0]
+        width, height = pack_layouts(layouts, name, margin)
+
+        packed = {'graphs': dict(), 'nodes': dict(), 'edges': dict()}
+        for layout in layouts:
+            for kind in packed:
+                packed[kind].update(layout[kind])
+        packed['graphs'][name] = {'bb': '"0,0,%.3f,%.3f"' % (width, height)}
+
+        with reader.pinned(self, packed):
+            return self.create(prog=['neato', '-n2'], format=format)
+
+    def acreate(self, prog=None, format='ps', timeout=None, semaphore=None,
+                cpu_time=None, address_space=None):
+        """Coroutine version of create(), for use with asyncio.
+
+        The graph is piped to the GraphViz program without blocking the
+        event loop. The program is killed when the coroutine is
+        cancelled. 'semaphore' can be an asyncio.Semaphore shared between
+        calls to limit how many programs run at the same time. Refer to
+        set_limits() for 'timeout', 'cpu_time' and 'address_space'.
+
+        Only available on Python 3.
+        """
+        from pydot_ng import _aio
+        return _aio.create(
+            self, prog, format, timeout, semaphore, cpu_time=cpu_time,
+            address_space=address_space)
+
+    def awrite(self, path, prog=None, format='raw', timeout=None,
+               semaphore=None, cpu_time=None, address_space=None):
+        """Coroutine version of write(), for use with asyncio.
+
+        Refer to acreate() for the meaning of the other arguments.
+
+        Unlike write(), the output isn't streamed: it's held in memory
+        until the program is done, then written to 'path' the way
+        write() does.
+
+        Only available on Python 3.
+        """
+        from pydot_ng import _aio
+        return _aio.write(
+            self, path, prog, format, timeout, semaphore, cpu_time=cpu_time,
+            address_space=address_space)
+
+
+def add_format_methods(cls):
+    """Define the create_'format' and write_'format' methods of a class.
+
+    One of each is defined for every format in cls.formats, plus
+    write_raw(). They use the program the graph has when they're called
+    unless one is given.
+    """
+    def make_create(frmt):
+        def create(self, prog=None, **kwargs):
+            return self.create(prog=prog, format=frmt, **kwargs)
+        return create
+
+    def make_write(frmt):
+        def write(self, path, prog=None, **kwargs):
+            return self.write(path, prog=prog, format=frmt, **kwargs)
+        return write
+
+    for frmt in cls.formats:
+        method = make_create(frmt)
+        method.__name__ = str('create_' + frmt)
+        method.__doc__ = (
+            '''Refer to the docstring accompanying the'''
+            ''''create' method for more information.''')
+        setattr(cls, method.__name__, method)
+
+    for frmt in cls.formats + ['raw']:
+        method = make_write(frmt)
+        method.__name__ = str('write_' + frmt)
+        method.__doc__ = (
+            '''Refer to the docstring accompanying the'''
+            ''''write' method for more information.''')
+        setattr(cls, method.__name__, method)
+
+
+add_format_methods(Dot)
+
+
+RenderResult = collections.namedtuple(
+    'RenderResult', ['index', 'graph', 'data', 'error'])
+
+
+def render_many(graphs, format='ps', prog=None, max_workers=None,
+                ordered=True):
+    """Render many graphs, running the GraphViz programs concurrently.
+
+    Returns an iterator over a RenderResult(index, graph, data, error)
+    for each of the Dot instances in 'graphs', 'index' being its
+    position. 'data' is what graph.create(prog, format) would return,
+    or None if that failed, in which case 'error' holds the exception.
+
+    Up to 'max_workers' programs run at the same time, by default as
+    many as there are CPUs. Graphs are serialized in the calling thread
+    as workers become available, so 'graphs' can be a generator. The
+    results come in the order of 'graphs' unless 'ordered' is False,
+    then they come as soon as they are ready.
+    """
+    if max_workers is None:
+        max_workers = getattr(os, 'cpu_count', lambda: None)() or 1
 
-        stderr = p.stderr
-        stdout = p.stdout
+    jobs = queue.Queue(max_workers)
+    results = queue.Queue()
+    stopped = threading.Event()
 
-        stdout_output = list()
+    def work():
         while True:
-            data = stdout.read()
-            if not data:
-                break
-            stdout_output.append(data)
-        stdout.close()
+            item = jobs.get()
+            if item is None:
+                return
+
+            index, graph, job = item
+            if stopped.is_set():
+                continue
+
+            try:
+                result = RenderResult(
+                    index, graph, Dot._run_create(job), None)
+            except Exception as e:
+                result = RenderResult(index, graph, None, e)
+            results.put(result)
+
+    workers = []
+    for _ in range(max_workers):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    finished = dict()
+    state = {'next': 0, 'pending': 0}
+
+    def collect(block):
+        # Yields the results which are ready, in order if needed.
+        while state['pending']:
+            try:
+                result = results.get(block)
+            except queue.Empty:
+                return
+            state['pending'] -= 1
+
+            if not ordered:
+                yield result
+                continue
+
+            finished[result.index] = result
+            while state['next'] in finished:
+                yield finished.pop(state['next'])
+                state['next'] += 1
 
-        stdout_output = NULL_SEP.join(stdout_output)
+    try:
+        for index, graph in enumerate(graphs):
+            state['pending'] += 1
+            try:
+                job = graph._prepare_create(prog, format)
+            except Exception as e:
+                results.put(RenderResult(index, graph, None, e))
+            else:
+                jobs.put((index, graph, job))
+
+            for result in collect(False):
+                yield result
+
+        for result in collect(True):
+            yield result
+    finally:
+        stopped.set()
+        for _ in workers:
+            jobs.put(None)
+
+
+def render_batch(graphs, format='ps', prog=None):
+    """Render many graphs running the GraphViz programs only a few times.
+
+    All the graphs rendered with the same program and arguments are
+    concatenated and fed to a single run of that program, saving the
+    cost of starting one for each graph. The outputs are split back
+    with the '-O' option of GraphViz, which names them after the input.
+
+    Returns a list with a RenderResult(index, graph, data, error) for
+    each of the Dot instances in 'graphs', like render_many(). Graphs
+    with shape files, and the ones left without an output because a
+    graph in their batch failed, are rendered on their own, so errors
+    are reported for the graph which caused them. The timeout of a
+    batch applies to its run, then once to all the graphs of the batch
+    rendered on their own, the ones left when it runs out fail with
+    InvocationTimeout.
+    """
+    graphs = list(graphs)
+    jobs = [None] * len(graphs)
+    results = [None] * len(graphs)
+    batches = collections.OrderedDict()
 
-        if not stderr.closed:
-            stderr_output = list()
-            while True:
-                data = stderr.read()
-                if not data:
-                    break
-                stderr_output.append(data)
-            stderr.close()
+    for index, graph in enumerate(graphs):
+        try:
+            job = jobs[index] = graph._prepare_create(prog, format)
+        except Exception as e:
+            results[index] = RenderResult(index, graph, None, e)
+            continue
 
-            if stderr_output:
-                stderr_output = NULL_SEP.join(stderr_output)
-                if PY3:
-                    stderr_output = stderr_output.decode(sys.stderr.encoding)
+        if job['output'] is not None:
+            results[index] = RenderResult(index, graph, job['output'], None)
+        elif not job['shape_files']:
+            key = (tuple(job['cmdline']),
+                   tuple(sorted(job['limits'].items())))
+            batches.setdefault(key, []).append(index)
+
+    for (cmdline, limits), indices in batches.items():
+        outputs = run_batch(
+            list(cmdline), [jobs[index]['data'] for index in indices], format,
+            dict(limits))
+
+        for index, output in zip(indices, outputs):
+            if output is None:
+                continue
+            job = jobs[index]
+            if job['cache'] is not None:
+                job['cache'].set(job['key'], output)
+            results[index] = RenderResult(index, graphs[index], output, None)
+
+    batch_keys = {}
+    for key, indices in batches.items():
+        for index in indices:
+            batch_keys[index] = key
+
+    deadlines = {}
+    for index, graph in enumerate(graphs):
+        if results[index] is not None:
+            continue
 
-        status = p.wait()
+        job = jobs[index]
+        timeout = job['limits']['timeout']
+        try:
+            if timeout is not None:
+                deadline = deadlines.setdefault(
+                    batch_keys.get(index, index), default_timer() + timeout)
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    Dot._raise_timeout(job, b'')
+                job['limits'] = dict(job['limits'], timeout=remaining)
+            results[index] = RenderResult(
+                index, graph, Dot._run_create(job), None)
+        except Exception as e:
+            results[index] = RenderResult(index, graph, None, e)
+
+    return results
+
+
+def get_output_suffix(format):
+    """Return the suffix GraphViz gives to the files the '-O' option names.
+
+    The parts of formats such as 'png:cairo:gd' are reversed, giving
+    'gd.cairo.png'.
+    """
+    return '.'.join(reversed(format.split(':')))
 
-        if status != 0:
-            raise InvocationException(
-                'Program terminated with status: %d. stderr follows: %s' % (
-                    status, stderr_output))
-        elif stderr_output:
-            print(stderr_output)
 
-        # For each of the image files...
-        for img in self.shape_files:
-            # remove it
-            os.unlink(os.path.join(tmp_dir, os.path.basename(img)))
+def run_batch(cmdline, data, format, limits=None):
+    """Run a GraphViz program once over many graphs in dot language.
 
-        os.unlink(tmp_name)
+    Returns the output for each item in 'data', or None for the graphs
+    whose output is missing or can't be trusted because the program
+    failed. 'limits' are the ones taken by Dot.create(), a timeout
+    applies to the whole run. The outputs completed before it ran out
+    are returned.
+    """
+    if limits is None:
+        limits = dict()
 
-        return stdout_output
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_name = 'batch.gv'
+        with open(os.path.join(tmp_dir, input_name), 'wb') as f:
+            for item in data:
+                f.write(item)
+                f.write(b'\n')
+
+        p = subprocess.Popen(
+            cmdline + ['-O', input_name],
+            cwd=tmp_dir,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+            **get_popen_limits(limits))
+        with reap_on_error(p):
+            with Watchdog(p, limits.get('timeout')) as watchdog:
+                stdout_output, stderr_output = p.communicate()
+
+        # GraphViz names the outputs batch.gv.png, batch.gv.2.png, ...
+        suffix = get_output_suffix(format)
+        outputs = []
+        for index in range(len(data)):
+            name = input_name
+            if index:
+                name += '.%d' % (index + 1)
+            try:
+                with open(os.path.join(tmp_dir, name + '.' + suffix),
+                          'rb') as f:
+                    outputs.append(f.read())
+            except EnvironmentError:
+                outputs.append(None)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if watchdog.fired:
+        # The outputs are written one after the other, all of them but
+        # the last one written are complete.
+        written = outputs.index(None) if None in outputs else len(outputs)
+        kept = max(written - 1, 0)
+        return outputs[:kept] + [None] * (len(outputs) - kept)
+
+    if p.returncode != 0:
+        # Which graph failed is unknown, the ones before the first
+        # missing output went through, the others are dropped.
+        if None not in outputs:
+            return [None] * len(outputs)
+        failed = outputs.index(None)
+        return outputs[:failed] + [None] * (len(outputs) - failed)
+
+    if stderr_output:
+        print(decode_stderr(stderr_output))
+
+    return outputs
+
+
+def get_node_name(point):
+    """Return the name of the node an edge end refers to, without port."""
+    if isinstance(point, (int, long)):
+        return str(point)
+    if point.startswith('"'):
+        return QUOTED_NAME_RE.match(point).group(0)
+    return point.partition(':')[0]
+
+
+QUOTED_NAME_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def get_components(graph):
+    """Split a Dot instance in its connected components.
+
+    Returns a Dot instance for each component, holding its nodes, the
+    edges between them and the subgraphs they are in, with the
+    attributes and defaults of the graph, but for its label. The
+    nodes of a cluster are kept in one component. The graph itself is
+    returned alone when it has edges to subgraphs.
+    """
+    parents = collections.OrderedDict()
+
+    def find(name):
+        parents.setdefault(name, name)
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    def union(names):
+        roots = [find(name) for name in names]
+        for root in roots[1:]:
+            parents[root] = roots[0]
+
+    def join(obj_dict, cluster):
+        # Returns the names of the nodes in a graph and its subgraphs.
+        names = []
+        for name in obj_dict['nodes']:
+            if name not in ('graph', 'node', 'edge'):
+                names.append(name)
+                find(name)
+
+        for points in obj_dict['edges']:
+            if isinstance(points[0], dict) or isinstance(points[1], dict):
+                raise ValueError
+            names.extend(get_node_name(point) for point in points)
+            union([get_node_name(point) for point in points])
+
+        for subgraphs in obj_dict['subgraphs'].values():
+            for subgraph in subgraphs:
+                names.extend(join(
+                    subgraph, subgraph['name'].strip('"').startswith(
+                        'cluster')))
+
+        if cluster and names:
+            union(names)
+        return names
+
+    try:
+        join(graph.obj_dict, False)
+    except ValueError:
+        return [graph]
+
+    roots = list(collections.OrderedDict(
+        (find(name), None) for name in list(parents)))
+    if len(roots) < 2:
+        return [graph]
+
+    def split(obj_dict):
+        # Returns copies of a graph holding the elements of each
+        # component, by root, in a single pass.
+        copies = dict()
+        defaults = dict(
+            (name, obj_dict['nodes'][name])
+            for name in ('graph', 'node', 'edge') if name in obj_dict['nodes'])
+
+        def get_copy(root):
+            if root not in copies:
+                copies[root] = dict(
+                    obj_dict, nodes=dict(defaults), edges=dict(),
+                    subgraphs=dict())
+            return copies[root]
+
+        for name, nodes in obj_dict['nodes'].items():
+            if name not in defaults:
+                get_copy(find(name))['nodes'][name] = nodes
+
+        for points, edges in obj_dict['edges'].items():
+            root = find(get_node_name(points[0]))
+            get_copy(root)['edges'][points] = edges
+
+        for name, subgraphs in obj_dict['subgraphs'].items():
+            for subgraph in subgraphs:
+                for root, copied in split(subgraph).items():
+                    get_copy(root)['subgraphs'].setdefault(
+                        name, []).append(copied)
+
+        return copies
+
+    copies = split(graph.obj_dict)
+    graphs = []
+    for root in roots:
+        obj_dict = copies[root]
+        obj_dict['attributes'] = dict(obj_dict['attributes'])
+        obj_dict['attributes'].pop('label', None)
+
+        component = Dot(obj_dict=obj_dict)
+        obj_dict['parent_graph'] = component
+        for name in ('prog', 'progs', 'shape_files', 'render_cache',
+                     'timeout', 'cpu_time', 'address_space',
+                     'instrumentation_hooks'):
+            setattr(component, name, getattr(graph, name))
+        graphs.append(component)
+
+    return graphs
+
+
+def translate_positions(value, dx, dy):
+    """Move the points in the value of a position attribute by (dx, dy).
+
+    The value can be a point, a spline with its 'e,' and 's,' end
+    points, or a bounding box, quoted or not.
+    """
+    quoted = value.startswith('"')
+    if quoted:
+        value = value[1:-1]
+
+    tokens = []
+    for token in value.split():
+        parts = token.split(',')
+        start = 1 if parts[0] in ('e', 's') else 0
+        for k in range(start, len(parts)):
+            number, pinned = parts[k].rstrip('!'), parts[k].endswith('!')
+            number = float(number) + (dy if (k - start) % 2 else dx)
+            parts[k] = ('%.3f' % number).rstrip('0').rstrip('.')
+            if pinned:
+                parts[k] += '!'
+        tokens.append(','.join(parts))
+
+    value = ' '.join(tokens)
+    if quoted:
+        value = '"%s"' % value
+    return value
+
+
+def pack_layouts(layouts, name, margin=8):
+    """Place the layouts of components next to each other, in shelves.
+
+    'layouts' are the layouts of graphs named 'name', as returned by
+    LayoutCache.read_layout(), which are moved in place, from the
+    tallest to the shortest, left to right and top to bottom in rows
+    about as wide as the whole is tall. Returns the width and height
+    of the packed layouts.
+    """
+    boxes = []
+    for layout in layouts:
+        bb = layout['graphs'].get(name, dict()).get('bb')
+        x0, y0, x1, y1 = [
+            float(value) for value in (bb or '0,0,0,0').strip('"').split(',')]
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+
+    area = sum((w + margin) * (h + margin) for _x, _y, w, h in boxes)
+    row_width = max([w for _x, _y, w, _h in boxes] + [area ** 0.5])
+
+    places = dict()
+    x = y = row_height = width = 0
+    for i in sorted(range(len(boxes)), key=lambda i: -boxes[i][3]):
+        w, h = boxes[i][2:]
+        if x > 0 and x + w > row_width:
+            x, y, row_height = 0, y + row_height + margin, 0
+        places[i] = (x, y)
+        width = max(width, x + w)
+        x += w + margin
+        row_height = max(row_height, h)
+    height = y + row_height
+
+    # Rows go down, the y axis of Graphviz up.
+    for i, layout in enumerate(layouts):
+        x0, y0, w, h = boxes[i]
+        dx = places[i][0] - x0
+        dy = height - places[i][1] - h - y0
+        kept = list(layout['graphs'].values())
+        kept.extend(layout['nodes'].values())
+        for positions in layout['edges'].values():
+            kept.extend(positions)
+        for positions in kept:
+            for attribute, value in positions.items():
+                positions[attribute] = translate_positions(value, dx, dy)
+
+    return width, height
@@ -0,0 +1,93 @@
+"""Rendering of graphs with asyncio.
+
+This module is only imported by Dot.acreate() and Dot.awrite(), it
+needs Python 3.
+"""
+import asyncio
+from timeit import default_timer
+
+import pydot_ng as pydot
+
+
+async def create(graph, prog, format, timeout=None, semaphore=None,
+                 **limits):
+    job = graph._prepare_create(prog, format, timeout=timeout, **limits)
+    if job['output'] is not None:
+        return job['output']
+
+    if semaphore is None:
+        return await run(job)
+
+    async with semaphore:
+        return await run(job)
+
+
+async def run(job):
+    hooks = job['hooks']
+    work_dir = pydot.Dot._stage_shape_files(job)
+    try:
+        if hooks:
+            start = default_timer()
+        process = await asyncio.create_subprocess_exec(
+            *job['cmdline'],
+            cwd=work_dir,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **pydot.get_popen_limits(job['limits']))
+
+        communicate = None
+        try:
+            if hooks:
+                pydot.notify_hooks(hooks, 'create.spawn', start)
+                start = default_timer()
+
+            communicate = asyncio.ensure_future(
+                process.communicate(job['data']))
+            done, _pending = await asyncio.wait(
+                [communicate], timeout=job['limits']['timeout'])
+        except BaseException:
+            # Cancelled or failed, don't leave the program running.
+            await kill(process)
+            if communicate is not None:
+                communicate.cancel()
+            raise
+
+        if not done:
+            # Once killed its pipes close, what it wrote until then can
+            # still be collected.
+            await kill(process)
+            stdout_output, stderr_output = await communicate
+            pydot.Dot._raise_timeout(job, stderr_output)
+
+        stdout_output, stderr_output = communicate.result()
+        if hooks:
+            pydot.notify_hooks(
+                hooks, 'create.run', start, status=process.returncode,
+                stdout_bytes=len(stdout_output),
+                stderr_bytes=len(stderr_output))
+    finally:
+        pydot.Dot._unstage_shape_files(job, work_dir)
+
+    return pydot.Dot._finish_create(
+        job, process.returncode, stdout_output, stderr_output)
+
+
+async def kill(process):
+    if process.returncode is None:
+        pydot.kill_process(process)
+        await process.wait()
+
+
+async def write(graph, path, prog, format, timeout=None, semaphore=None,
+                **limits):
+    if format == 'raw':
+        data = graph._to_bytes()
+    else:
+        data = await create(
+            graph, prog, format, timeout, semaphore, **limits)
+
+    with pydot.open_output(path) as fobj:
+        fobj.write(data)
+
+    return True
@@ -11,10 +11,14 @@
 from __future__ import division
 from __future__ import print_function
 
-import codecs
+import os
 import pydot_ng as pydot
 import pyparsing
 import sys
+from pydot_ng._dotscan import (
+    IDENTIFIER_PATTERN, NUMBER_PATTERN, QUOTED_ID_PATTERN, decode_dot_data,
+    get_lazy_scan_res, is_binary, skip_html, sniff_charset)
+from timeit import default_timer
 
 
 __author__ = ['Michael Krause', 'Ero Carrera']
@@ -25,6 +29,7 @@ PY3 = not sys.version_info < (3, 0, 0)
 
 if PY3:
     basestring = str
+    unicode = str
 
 
 class P_AttrList(object):
@@ -63,8 +68,17 @@ class DefaultStatement(P_AttrList):
 top_graphs = list()
 
 
+def push_graph_type_stmt(str, loc, toks):
+    # The top graph is created as soon as its header is matched, so that
+    # the elements in its body can be linked to it while they are parsed.
+    g = pydot.Dot(graph_type=toks[0][0])
+    top_graphs.append(g)
+    return g
+
+
 def push_top_graph_stmt(str, loc, toks):
     attrs = {}
+    graphs = []
     g = None
 
     for element in toks:
@@ -75,23 +89,20 @@ def push_top_graph_stmt(str, loc, toks):
         if element == 'strict':
             attrs['strict'] = True
 
-        elif element in ['graph', 'digraph']:
+        elif isinstance(element, pydot.Dot):
             attrs = {}
-
-            g = pydot.Dot(graph_type=element, **attrs)
-            attrs['type'] = element
-
-            top_graphs.append(g)
+            g = element
+            graphs.append(g)
 
         elif isinstance(element, basestring):
             g.set_name(element)
 
         elif isinstance(element, pydot.Subgraph):
-            g.obj_dict['attributes'].update(element.obj_dict['attributes'])
-            g.obj_dict['edges'].update(element.obj_dict['edges'])
-            g.obj_dict['nodes'].update(element.obj_dict['nodes'])
-            g.obj_dict['subgraphs'].update(element.obj_dict['subgraphs'])
-            g.set_parent_graph(g)
+            # The body of the graph was parsed into a subgraph whose
+            # elements already point to g, take over its dictionaries.
+            for key in ('attributes', 'edges', 'nodes', 'subgraphs',
+                        'current_child_sequence'):
+                g.obj_dict[key] = element.obj_dict[key]
 
         elif isinstance(element, P_AttrList):
             attrs.update(element.attrs)
@@ -102,48 +113,10 @@ def push_top_graph_stmt(str, loc, toks):
         else:
             raise ValueError("Unknown element statement: %r " % element)
 
-    for g in top_graphs:
-        update_parent_graph_hierarchy(g)
-
-    if len(top_graphs) == 1:
-        return top_graphs[0]
-
-    return top_graphs
-
-
-def update_parent_graph_hierarchy(g, parent_graph=None, level=0):
-    if parent_graph is None:
-        parent_graph = g
-
-    for key_name in ('edges',):
-        if isinstance(g, pydot.frozendict):
-            item_dict = g
-        else:
-            item_dict = g.obj_dict
-
-        if key_name not in item_dict:
-            continue
+    if len(graphs) == 1:
+        return graphs[0]
 
-        for key, objs in item_dict[key_name].items():
-            for obj in objs:
-                if ('parent_graph' in obj and
-                        obj['parent_graph'].get_parent_graph() == g):
-                    if obj['parent_graph'] is g:
-                        pass
-                    else:
-                        obj['parent_graph'].set_parent_graph(parent_graph)
-
-                if key_name == 'edges' and len(key) == 2:
-                    for vertex in obj['points']:
-                        if isinstance(vertex, (pydot.Graph, pydot.Subgraph,
-                                               pydot.Cluster)):
-                            vertex.set_parent_graph(parent_graph)
-                        if isinstance(vertex, pydot.frozendict):
-                            if vertex['parent_graph'] is g:
-                                pass
-                            else:
-                                vertex['parent_graph'].\
-                                    set_parent_graph(parent_graph)
+    return graphs
 
 
 def add_defaults(element, defaults):
@@ -170,6 +143,10 @@ def add_elements(g, toks, defaults_graph=None, defaults_node=None,
         elif isinstance(element, pydot.Node):
             add_defaults(element, defaults_node)
             g.add_node(element)
+            element.set_parent_graph(g.get_parent_graph())
+
+        elif isinstance(element, EdgeStatement):
+            add_edge_stmt(g, element)
 
         elif isinstance(element, pydot.Edge):
             add_defaults(element, defaults_edge)
@@ -181,23 +158,17 @@ def add_elements(g, toks, defaults_graph=None, defaults_node=None,
                              defaults_edge)
 
         elif isinstance(element, DefaultStatement):
-            if element.default_type == 'graph':
-                default_graph_attrs = pydot.Node('graph', **element.attrs)
-                g.add_node(default_graph_attrs)
+            if element.default_type not in ('graph', 'node', 'edge'):
+                raise ValueError("Unknown DefaultStatement: {0} ".
+                                 format(element.default_type))
 
-            elif element.default_type == 'node':
-                default_node_attrs = pydot.Node('node', **element.attrs)
-                g.add_node(default_node_attrs)
+            default_attrs = pydot.Node(element.default_type, **element.attrs)
+            g.add_node(default_attrs)
+            default_attrs.set_parent_graph(g.get_parent_graph())
 
-            elif element.default_type == 'edge':
-                default_edge_attrs = pydot.Node('edge', **element.attrs)
-                g.add_node(default_edge_attrs)
+            if element.default_type == 'edge':
                 defaults_edge.update(element.attrs)
 
-            else:
-                raise ValueError("Unknown DefaultStatement: {0} ".
-                                 format(element.default_type))
-
         elif isinstance(element, P_AttrList):
             g.obj_dict['attributes'].update(element.attrs)
 
@@ -207,12 +178,14 @@ def add_elements(g, toks, defaults_graph=None, defaults_node=None,
 
 def push_graph_stmt(str, loc, toks):
     g = pydot.Subgraph('')
+    g.set_parent_graph(top_graphs[-1])
     add_elements(g, toks)
     return g
 
 
 def push_subgraph_stmt(str, loc, toks):
     g = pydot.Subgraph('')
+    g.set_parent_graph(top_graphs[-1])
 
     for e in toks:
         if len(e) == 3:
@@ -267,56 +240,81 @@ def do_node_ports(node):
     return node_port
 
 
-def push_edge_stmt(str, loc, toks):
-    tok_attrs = [a for a in toks if isinstance(a, P_AttrList)]
-    attrs = {}
-
-    for a in tok_attrs:
-        attrs.update(a.attrs)
+class EdgeStatement(object):
+    """An edge statement, possibly a chain of several edges.
 
-    e = []
-
-    if isinstance(toks[0][0], pydot.Graph):
-        n_prev = pydot.frozendict(toks[0][0].obj_dict)
-    else:
-        n_prev = toks[0][0] + do_node_ports(toks[0])
+    'points' holds the end points of the chain, in order, and 'attrs'
+    the attributes that apply to every edge in it. An end point is a
+    node ID, a frozen subgraph or a list of node IDs.
+    """
 
-    if isinstance(toks[2][0], pyparsing.ParseResults):
-        n_next_list = [[n.get_name()] for n in toks[2][0]]
-        for n_next in [n for n in n_next_list]:
-            n_next_port = do_node_ports(n_next)
-            e.append(pydot.Edge(n_prev, n_next[0] + n_next_port, **attrs))
+    def __init__(self, points, attrs):
+        self.points = points
+        self.attrs = attrs
 
-    elif isinstance(toks[2][0], pydot.Graph):
-        e.append(pydot.Edge(n_prev, pydot.frozendict(toks[2][0].obj_dict),
-                            **attrs))
+    def __repr__(self):
+        return "%s(%r, %r)" % (
+            self.__class__.__name__, self.points, self.attrs)
 
-    elif isinstance(toks[2][0], pydot.Node):
-        node = toks[2][0]
 
-        if node.get_port() is not None:
-            name_port = node.get_name() + ":" + node.get_port()
-        else:
-            name_port = node.get_name()
+def get_edge_point(point):
+    head = point[0]
 
-        e.append(pydot.Edge(n_prev, name_port, **attrs))
+    if isinstance(head, pydot.Graph):
+        return pydot.frozendict(head.obj_dict)
 
-    elif isinstance(toks[2][0], type('')):
-        for n_next in [n for n in tuple(toks)[2::2]]:
-            if isinstance(n_next, P_AttrList) or not isinstance(n_next[0],
-                                                                type('')):
-                continue
+    if isinstance(head, pyparsing.ParseResults):
+        return [pydot.quote_if_necessary(n.get_name()) for n in head]
 
-            n_next_port = do_node_ports(n_next)
-            e.append(pydot.Edge(n_prev, n_next[0] + n_next_port, **attrs))
+    if isinstance(head, pydot.Node):
+        if head.get_port() is not None:
+            return pydot.quote_if_necessary(
+                head.get_name() + ":" + head.get_port())
+        return pydot.quote_if_necessary(head.get_name())
 
-            n_prev = n_next[0] + n_next_port
+    return pydot.quote_if_necessary(head + do_node_ports(point))
 
-    else:
-        # UNEXPECTED EDGE TYPE
-        pass
 
-    return e
+def push_edge_stmt(str, loc, toks):
+    attrs = {}
+    points = []
+
+    for tok in toks:
+        if isinstance(tok, P_AttrList):
+            attrs.update(tok.attrs)
+        elif isinstance(tok, pyparsing.ParseResults):
+            points.append(get_edge_point(tok))
+
+    return EdgeStatement(points, attrs)
+
+
+def add_edge_stmt(g, stmt):
+    """Add all the edges of an edge statement to a graph.
+
+    The edge dictionaries are built and stored directly, each with its
+    own copy of the statement's attributes.
+    """
+    edges = g.obj_dict['edges']
+    parent_graph = g.get_parent_graph()
+    attrs = stmt.attrs
+
+    for src, dst in zip(stmt.points, stmt.points[1:]):
+        for src_id in (src if isinstance(src, list) else [src]):
+            for dst_id in (dst if isinstance(dst, list) else [dst]):
+                edge_points = (src_id, dst_id)
+                obj_dict = {
+                    'attributes': dict(attrs),
+                    'type': 'edge',
+                    'parent_graph': parent_graph,
+                    'parent_edge_list': None,
+                    'sequence': g.get_next_sequence_number(),
+                    'points': edge_points,
+                }
+
+                if edge_points in edges:
+                    edges[edge_points].append(obj_dict)
+                else:
+                    edges[edge_points] = [obj_dict]
 
 
 def push_node_stmt(s, loc, toks):
@@ -354,7 +352,6 @@ def graph_definition():
         comma = pyparsing.Literal(",")
         semi = pyparsing.Literal(";")
         at = pyparsing.Literal("@")
-        minus = pyparsing.Literal("-")
 
         # keypyparsing.Words
         strict_ = pyparsing.CaselessLiteral("strict")
@@ -365,12 +362,13 @@ def graph_definition():
         edge_ = pyparsing.CaselessLiteral("edge")
 
         # token definitions
-        identifier = pyparsing.Word(pyparsing.alphanums + "_.").\
+        # The scanner behind dot_stats() shares the patterns of the
+        # identifiers, quoted strings and numbers.
+        identifier = pyparsing.Regex(IDENTIFIER_PATTERN).\
             setName("identifier")
 
-        # dblpyparsing.QuotedString
-        double_quoted_string = pyparsing.QuotedString('"', multiline=True,
-                                                      unquoteResults=False)
+        double_quoted_string = pyparsing.Regex(QUOTED_ID_PATTERN).\
+            setName("double_quoted_string")
 
         noncomma_ = "".join([c for c in pyparsing.printables if c != ","])
         alphastring_ = pyparsing.OneOrMore(pyparsing.CharsNotIn(noncomma_ +
@@ -391,9 +389,7 @@ def graph_definition():
             double_quoted_string |
             alphastring_).setName("ID")
 
-        float_number = pyparsing.Combine(
-            pyparsing.Optional(minus) +
-            pyparsing.OneOrMore(pyparsing.Word(pyparsing.nums + "."))).\
+        float_number = pyparsing.Regex(NUMBER_PATTERN).\
             setName("float_number")
 
         righthand_id = (float_number | ID).setName("righthand_id")
@@ -455,9 +451,13 @@ def graph_definition():
         stmt_list << pyparsing.OneOrMore(stmt + pyparsing.Optional(
             semi.suppress()))
 
+        # The action is set right away since setResultsName() below
+        # copies the expressions it is made of.
+        graph_type = pyparsing.Group((graph_ | digraph_)).\
+            setParseAction(push_graph_type_stmt)
+
         graphparser = pyparsing.OneOrMore((
-            pyparsing.Optional(strict_) +
-            pyparsing.Group((graph_ | digraph_)) +
+            pyparsing.Optional(strict_) + graph_type +
             pyparsing.Optional(ID) + graph_stmt).
             setResultsName("graph"))
 
@@ -481,31 +481,215 @@ def graph_definition():
     return graphparser
 
 
-def parse_dot_data(data):
-    global top_graphs
+LAZY_MARKER = '__pydot_lazy__'
 
-    top_graphs = list()
 
-    if PY3:
-        if isinstance(data, bytes):
-            # this is extremely hackish
+def find_lazy_subgraphs(data):
+    """Find the bodies of the subgraph statements of the top graphs.
+
+    This is a cheap brace matching pass over data, no tokens are built.
+    It returns a list of (start, end) offsets, each spanning the text
+    between the braces of a 'subgraph [ID] { ... }' statement placed
+    directly in a top graph. Subgraphs used as edge endpoints are left
+    out, as edges need their contents right away.
+    """
+    scan_re, angles_re, spaces_re = get_lazy_scan_res(data)
+
+    ranges = []
+    depth = 0
+    pending = None
+    body_start = None
+    pos = 0
+
+    while True:
+        m = scan_re.search(data, pos)
+        if m is None:
+            break
+
+        tok = m.group()[:1]
+        pos = m.end()
+
+        if tok in ('{', b'{'):
+            depth += 1
+            if depth == 2 and pending is not None:
+                body_start = pos
+            pending = None
+
+        elif tok in ('}', b'}'):
+            if depth == 2 and body_start is not None:
+                nxt = spaces_re.match(data, pos).end()
+                if data[nxt:nxt + 2] not in ('->', '--', b'->', b'--'):
+                    ranges.append((body_start, m.start()))
+                body_start = None
+            depth -= 1
+            pending = None
+
+        elif tok in ('<', b'<'):
+            pos = skip_html(data, m.start(), angles_re)
+
+        elif tok in ('"', b'"', '/', b'/', '#', b'#'):
+            continue
+
+        elif depth == 1:
+            prev = data[max(0, m.start() - 256):m.start()].rstrip()
+            if prev[-2:] not in ('->', '--', b'->', b'--'):
+                pending = m.start()
+
+    return ranges
+
+
+class LazySource(object):
+    """Where the bodies of lazily loaded subgraphs are in the DOT source.
+
+    Only their offsets are kept, a body is read when its subgraph is
+    first used. Sources of graphs loaded from a file open it again for
+    that, the file must not change meanwhile. Other sources keep the
+    data they were parsed from.
+    """
+
+    def __init__(self, data, ranges, charset=None, path=None):
+        self.ranges = ranges
+        self.charset = charset
+        self.path = path
+        self.data = None
+        self.stamp = None
+
+        if path is not None:
+            self.stamp = get_file_stamp(path)
+        elif isinstance(data, (bytes, unicode)):
+            self.data = data
+        else:
+            # Buffers, such as memory maps, may be closed once parsed.
+            self.data = bytes(data)
+
+    def read(self, idx):
+        start, end = self.ranges[idx]
+        if self.path is None:
+            body = self.data[start:end]
+        else:
+            with open(self.path, 'rb') as fd:
+                if get_file_stamp(fd) != self.stamp:
+                    raise pydot.Error(
+                        '%s changed since its graph was loaded' % self.path)
+                fd.seek(start)
+                body = fd.read(end - start)
+
+        if self.charset is not None:
             try:
-                idx = data.index(b'charset') + 7
-                while data[idx] in b' \t\n\r=':
-                    idx += 1
-                fst = idx
-                while data[idx] not in b' \t\n\r];,':
-                    idx += 1
-                charset = data[fst:idx].strip(b'"\'').decode('ascii')
-                data = data.decode(charset)
+                body = body.decode(self.charset)
             except Exception:
-                data = data.decode('utf-8')
+                body = body.decode('utf-8')
+        return body
+
+
+def get_file_stamp(path_or_fd):
+    if hasattr(path_or_fd, 'fileno'):
+        info = os.fstat(path_or_fd.fileno())
     else:
-        if data.startswith(codecs.BOM_UTF8):
-            data = data.decode('utf-8')
+        info = os.stat(path_or_fd)
+    return info.st_size, info.st_mtime
+
+
+def strip_lazy_subgraphs(data, ranges):
+    """Replace the subgraph bodies in data by numbered markers."""
+    chunks = []
+    last = 0
+
+    for idx, (start, end) in enumerate(ranges):
+        marker = ' %s=%d ' % (LAZY_MARKER, idx)
+        if is_binary(data):
+            marker = marker.encode('ascii')
+        chunks.append(data[last:start])
+        chunks.append(marker)
+        last = end
+
+    chunks.append(data[last:])
+    return data[:0].join(chunks)
+
+
+def set_lazy_sources(graph, source):
+    for sgraphs in graph.obj_dict['subgraphs'].values():
+        for obj_dict in sgraphs:
+            idx = obj_dict['attributes'].pop(LAZY_MARKER, None)
+            if idx is not None:
+                obj_dict['lazy_source'] = (source, int(idx))
+
+
+def load_lazy_subgraph(obj_dict):
+    """Parse the body of a lazily loaded subgraph into its obj_dict."""
+    source, idx = obj_dict['lazy_source']
+    body = source.read(idx)
+    del obj_dict['lazy_source']
+    parent_graph = obj_dict['parent_graph']
+
+    data = '%s { %s }' % (parent_graph.get_top_graph_type(), body)
+    graph = parse_dot_data(data)
+    if graph is None or isinstance(graph, list):
+        obj_dict['lazy_source'] = (source, idx)
+        raise pydot.Error(
+            'Unable to parse the body of subgraph %s' % obj_dict['name'])
+
+    obj_dict['attributes'].update(graph.obj_dict['attributes'])
+    for key in ('nodes', 'edges', 'subgraphs', 'current_child_sequence'):
+        obj_dict[key] = graph.obj_dict[key]
+
+    pydot.Graph(obj_dict=obj_dict).set_parent_graph(parent_graph)
+
+
+def count_elements(obj_dicts, counts=None):
+    """Count the nodes, edges and subgraphs in the given graphs' obj_dicts.
+
+    Subgraphs which are still to be loaded lazily are not looked into.
+    """
+    if counts is None:
+        counts = {'nodes': 0, 'edges': 0, 'subgraphs': 0}
+
+    for obj_dict in obj_dicts:
+        counts['nodes'] += sum(map(len, obj_dict['nodes'].values()))
+        counts['edges'] += sum(map(len, obj_dict['edges'].values()))
+        for subgraphs in obj_dict['subgraphs'].values():
+            counts['subgraphs'] += len(subgraphs)
+            count_elements(subgraphs, counts)
+
+    return counts
+
+
+def parse_dot_data(data, lazy=False, path=None):
+    global top_graphs
+
+    top_graphs = list()
+
+    hooks = pydot.INSTRUMENTATION_HOOKS
+    if hooks:
+        hooks = list(hooks)
+
+    charset = None
+    if is_binary(data):
+        charset = sniff_charset(data)
+
+    if lazy:
+        if hooks:
+            start = default_timer()
+        ranges = find_lazy_subgraphs(data)
+        source = LazySource(data, ranges, charset, path)
+        data = strip_lazy_subgraphs(data, ranges)
+        if hooks:
+            pydot.notify_hooks(hooks, 'parse.scan', start,
+                               subgraphs=len(ranges))
+
+    if hooks:
+        start = default_timer()
+        size = len(data)
+    data = decode_dot_data(data, charset)
+    if hooks:
+        pydot.notify_hooks(hooks, 'parse.decode', start, bytes=size,
+                           chars=len(data))
 
     try:
 
+        if hooks:
+            start = default_timer()
+
         graphparser = graph_definition()
 
         if pyparsing.__version__ >= '1.2':
@@ -513,6 +697,19 @@ def parse_dot_data(data):
 
         tokens = graphparser.parseString(data)
 
+        if hooks:
+            counts = count_elements([graph.obj_dict for graph in tokens])
+            pydot.notify_hooks(hooks, 'parse.parse', start,
+                               graphs=len(tokens), **counts)
+
+        if lazy:
+            if hooks:
+                start = default_timer()
+            for graph in tokens:
+                set_lazy_sources(graph, source)
+            if hooks:
+                pydot.notify_hooks(hooks, 'parse.link', start)
+
         if len(tokens) == 1:
             return tokens[0]
         else:
@@ -0,0 +1,385 @@
+"""A pyparsing-free scanner of the DOT language.
+
+Used by dot_stats() and the parser, it splits DOT data into tokens,
+walks over the structure of graphs without building them and reads
+and decodes DOT files and streams.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import bz2
+import codecs
+import functools
+import re
+import sys
+import zlib
+
+
+PY3 = not sys.version_info < (3, 0, 0)
+
+if PY3:
+    unicode = str
+
+
+# The tokens of the grammar in _dotparser, which builds them from these
+# patterns so the scanner below reads IDs and numbers as the parser does:
+# unquoted IDs are ASCII letters, digits, underscores and dots, quoted IDs
+# end at the next double quote and numbers are digits and dots, maybe
+# after a minus sign.
+IDENTIFIER_PATTERN = r'[A-Za-z0-9_.]+'
+QUOTED_ID_PATTERN = r'"[^"]*"'
+NUMBER_PATTERN = r'-?[0-9.]+'
+
+# The grammar takes runs of other characters as IDs, such as non-ASCII
+# names, which the scanner only approximates.
+OTHER_ID_PATTERN = r'[^\x00-\x7f]+'
+
+COMMENT_PATTERN = r'//[^\n]*|#[^\n]*|/\*.*?\*/'
+
+# Tokens the lazy loader needs to see while matching braces. Quoted IDs,
+# comments and HTML labels are matched so that braces inside them are
+# skipped, everything else is jumped over by the regular expression engine.
+LAZY_SCAN_PATTERN = (
+    QUOTED_ID_PATTERN + '|' + COMMENT_PATTERN +
+    r'|[{}<]|(?<![\w.])subgraph(?![\w.])')
+
+# The tokens of the grammar, good enough to walk over the structure of a
+# graph without running it. Unsigned numbers are read as identifiers, as
+# the grammar does for node names.
+TOKEN_PATTERN = '|'.join([
+    r'\s+', COMMENT_PATTERN, QUOTED_ID_PATTERN, '->', '--',
+    IDENTIFIER_PATTERN, NUMBER_PATTERN, OTHER_ID_PATTERN, '.'])
+
+token_re = re.compile(TOKEN_PATTERN, re.S | re.U)
+
+# The tokens which are node names where the grammar expects an ID.
+id_re = re.compile('(?:%s)$|<' % '|'.join([
+    IDENTIFIER_PATTERN, QUOTED_ID_PATTERN, OTHER_ID_PATTERN]), re.S | re.U)
+
+lazy_scan_res = {}
+
+
+def get_lazy_scan_res(data):
+    """Return the scanning regular expressions matching the type of data."""
+    key = is_binary(data)
+
+    if key not in lazy_scan_res:
+        pattern, angles, spaces = LAZY_SCAN_PATTERN, '[<>]', r'\s*'
+        if key:
+            pattern, angles, spaces = (
+                pattern.encode('ascii'), b'[<>]', spaces.encode('ascii'))
+        lazy_scan_res[key] = (
+            re.compile(pattern, re.S | re.I), re.compile(angles),
+            re.compile(spaces))
+
+    return lazy_scan_res[key]
+
+
+def skip_html(data, pos, angles_re):
+    depth = 0
+    for m in angles_re.finditer(data, pos):
+        if m.group()[:1] in ('<', b'<'):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    return len(data)
+
+
+def iter_tokens(data):
+    """Split a DOT string into tokens, leaving whitespace and comments out.
+
+    HTML strings are returned as a single token.
+    """
+    angles_re = get_lazy_scan_res(data)[1]
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+        m = token_re.match(data, pos)
+        tok = m.group()
+        if tok == '<':
+            pos = skip_html(data, pos, angles_re)
+            yield data[m.start():pos]
+            continue
+
+        pos = m.end()
+        if tok[0].isspace() or tok[0] == '#' or tok[:2] in ('//', '/*'):
+            continue
+        yield tok
+
+
+def unquote(name):
+    if len(name) > 1 and name[0] == name[-1] == '"':
+        return name[1:-1]
+    return name
+
+
+def new_stats(graph_type, strict):
+    return {
+        'graph_type': graph_type,
+        'strict': strict,
+        'nodes': 0,
+        'edges': 0,
+        'subgraphs': 0,
+        'clusters': 0,
+        'max_depth': 0,
+        'attributes': set(),
+    }
+
+
+def scan_dot_stats(data):
+    """Collect structural statistics of DOT data without building a graph.
+
+    It returns a dictionary per graph in data with the keys:
+
+        graph_type  'graph' or 'digraph'
+        strict      whether the graph was declared as strict
+        nodes       the number of distinct nodes
+        edges       the number of edges, as Graphviz would create them
+                    (a -> {b c} counts as two edges)
+        subgraphs   the number of subgraphs, clusters included
+        clusters    the number of clusters
+        max_depth   the deepest nesting of subgraphs, 0 if there are none
+        attributes  the sorted list of the attribute names used
+
+    A single dictionary is returned if data holds only one graph.
+    """
+    data = decode_dot_data(data)
+
+    tokens = iter_tokens(data)
+    pushed = []
+
+    def next_token():
+        if pushed:
+            return pushed.pop()
+        return next(tokens, None)
+
+    all_stats = []
+    stats = None
+    strict = False
+    node_names = set()
+
+    # Each open block keeps the nodes it mentions, the nodes at the end of
+    # the last edge point and whether an edge operator is pending.
+    frames = []
+
+    def edge_point(frame, nodes):
+        if frame[2] and frame[1] is not None:
+            stats['edges'] += len(frame[1]) * len(nodes)
+        frame[1] = nodes
+        frame[2] = False
+
+    while True:
+        tok = next_token()
+        if tok is None:
+            break
+        low = tok.lower()
+
+        if not frames:
+            if low == 'strict':
+                strict = True
+            elif low in ('graph', 'digraph'):
+                stats = new_stats(low, strict)
+                all_stats.append(stats)
+                node_names = set()
+                strict = False
+            elif tok == '{' and stats is not None:
+                frames.append([set(), None, False])
+            continue
+
+        frame = frames[-1]
+
+        if tok == '{':
+            stats['subgraphs'] += 1
+            frames.append([set(), None, False])
+            stats['max_depth'] = max(stats['max_depth'], len(frames) - 1)
+
+        elif tok == '}':
+            nodes = frames.pop()[0]
+            if not frames:
+                stats['nodes'] = len(node_names)
+                stats['attributes'] = sorted(stats['attributes'])
+                continue
+            frames[-1][0].update(nodes)
+            edge_point(frames[-1], nodes)
+
+        elif low == 'subgraph':
+            name = next_token()
+            if name == '{':
+                pushed.append(name)
+            elif name is not None and unquote(name).startswith('cluster'):
+                stats['clusters'] += 1
+
+        elif tok == '[':
+            while True:
+                tok = next_token()
+                if tok is None or tok == ']':
+                    break
+                if tok == '=':
+                    next_token()
+                elif tok not in (',', ';'):
+                    stats['attributes'].add(unquote(tok))
+            frame[1] = None
+            frame[2] = False
+
+        elif tok in (';', ','):
+            frame[1] = None
+            frame[2] = False
+
+        elif tok in ('->', '--'):
+            frame[2] = True
+
+        elif tok in (':', '@'):
+            next_token()
+
+        elif low in ('node', 'edge', 'graph'):
+            frame[1] = None
+
+        elif id_re.match(tok):
+            nxt = next_token()
+            if nxt == '=':
+                stats['attributes'].add(unquote(tok))
+                next_token()
+                frame[1] = None
+                continue
+            if nxt is not None:
+                pushed.append(nxt)
+
+            name = unquote(tok)
+            node_names.add(name)
+            frame[0].add(name)
+            edge_point(frame, set([name]))
+
+    if stats is not None and frames:
+        stats['nodes'] = len(node_names)
+        stats['attributes'] = sorted(stats['attributes'])
+
+    if len(all_stats) == 1:
+        return all_stats[0]
+    return all_stats
+
+
+# Only the beginning of the data is searched for the charset attribute,
+# as it is normally set in the first lines of a file.
+CHARSET_SNIFF_SIZE = 64 * 1024
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def is_binary(data):
+    """Whether data is raw bytes (or a buffer) that must be decoded."""
+    return PY3 and not isinstance(data, str)
+
+
+def sniff_charset(data, size=CHARSET_SNIFF_SIZE):
+    """Look for the charset attribute in the raw bytes of a DOT file.
+
+    Only the first 'size' bytes are searched, all of them if 'size'
+    is None. 'data' can be bytes or any object supporting find() and
+    slicing, such as a memory map.
+    """
+    # this is extremely hackish
+    try:
+        idx = data.find(b'charset', 0, size or len(data))
+        if idx < 0:
+            raise ValueError('charset not found')
+        idx += 7
+        while data[idx:idx + 1] in b' \t\n\r=':
+            idx += 1
+        fst = idx
+        while data[idx:idx + 1] not in b' \t\n\r];,':
+            idx += 1
+        charset = data[fst:idx].strip(b'"\'').decode('ascii')
+        codecs.lookup(charset)
+    except Exception:
+        charset = 'utf-8'
+    return charset
+
+
+def decode_dot_data(data, charset=None):
+    if is_binary(data):
+        if charset is None:
+            charset = sniff_charset(data)
+        # str() decodes straight from the buffer, memory maps included,
+        # without making an intermediate copy of the bytes.
+        try:
+            return str(data, charset)
+        except Exception:
+            pass
+
+        # The charset may be declared past the sniffed prefix.
+        full_charset = sniff_charset(data, None)
+        if full_charset != charset:
+            try:
+                return str(data, full_charset)
+            except Exception:
+                pass
+        data = str(data, 'utf-8')
+    elif not PY3:
+        if data.startswith(codecs.BOM_UTF8):
+            data = data.decode('utf-8')
+    return data
+
+
+def iter_stream_chunks(stream, size=STREAM_CHUNK_SIZE):
+    """Read a stream in chunks, decompressing gzip and bz2 data."""
+    chunk = stream.read(size)
+
+    if chunk[:2] == b'\x1f\x8b':
+        new_decompressor = functools.partial(
+            zlib.decompressobj, 16 + zlib.MAX_WBITS)
+    elif chunk[:3] == b'BZh':
+        new_decompressor = bz2.BZ2Decompressor
+    else:
+        new_decompressor = None
+
+    decompressor = new_decompressor and new_decompressor()
+
+    while chunk:
+        if decompressor is None:
+            yield chunk
+        else:
+            # Concatenated streams are decompressed one after the other.
+            while chunk:
+                if getattr(decompressor, 'eof', False):
+                    decompressor = new_decompressor()
+                yield decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = new_decompressor()
+        chunk = stream.read(size)
+
+
+def read_dot_stream(stream):
+    """Read DOT data from a file object.
+
+    Binary streams are decoded incrementally as they are read, with
+    the charset found at their beginning. Streams of gzip or bz2
+    compressed data are decompressed on the fly.
+    """
+    chunks = iter_stream_chunks(stream)
+
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        head_size += len(chunk)
+        if isinstance(chunk, unicode) or head_size >= CHARSET_SNIFF_SIZE:
+            break
+
+    if not head:
+        return ''
+
+    if not is_binary(head[0]):
+        return head[0][:0].join(head + list(chunks))
+
+    head = b''.join(head)
+    decoder = codecs.getincrementaldecoder(sniff_charset(head))()
+    data = [decoder.decode(head)]
+    for chunk in chunks:
+        data.append(decoder.decode(chunk))
+    data.append(decoder.decode(b'', True))
+
+    return ''.join(data)
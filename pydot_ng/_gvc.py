@@ -0,0 +1,122 @@
+"""Rendering of graphs through the GraphViz libraries, loaded with ctypes.
+
+Used by Dot.create() with backend='libgvc', saving the cost of starting
+a GraphViz program for each graph. The libraries aren't thread-safe,
+all the calls into them are serialized.
+"""
+import ctypes
+import ctypes.util
+import threading
+
+import pydot_ng as pydot
+
+
+lock = threading.Lock()
+
+# The loaded libraries and the GraphViz context, False when loading failed.
+state = {'gvc': None, 'cgraph': None, 'context': None}
+
+LIBRARY_NAMES = {
+    'gvc': ['gvc', 'libgvc-6', 'libgvc'],
+    'cgraph': ['cgraph', 'libcgraph-6', 'libcgraph'],
+}
+
+
+def find_library(name):
+    for candidate in LIBRARY_NAMES[name]:
+        path = ctypes.util.find_library(candidate)
+        if path is not None:
+            return ctypes.CDLL(path)
+
+    raise OSError('GraphViz library "%s" not found' % name)
+
+
+def load():
+    """Load the libraries once, returning False if they aren't available."""
+    if state['gvc'] is not None:
+        return state['gvc'] is not False
+
+    with lock:
+        if state['gvc'] is not None:
+            return state['gvc'] is not False
+
+        try:
+            gvc = find_library('gvc')
+            cgraph = find_library('cgraph')
+        except OSError:
+            state['gvc'] = False
+            return False
+
+        gvc.gvContext.restype = ctypes.c_void_p
+        gvc.gvContext.argtypes = []
+        gvc.gvLayout.restype = ctypes.c_int
+        gvc.gvLayout.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p]
+        gvc.gvFreeLayout.restype = ctypes.c_int
+        gvc.gvFreeLayout.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        # The length is an unsigned int before GraphViz 2.42 and a size_t
+        # after, a zeroed size_t reads correctly either way on the little
+        # endian platforms GraphViz ships for.
+        gvc.gvRenderData.restype = ctypes.c_int
+        gvc.gvRenderData.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+            ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t)]
+        gvc.gvFreeRenderData.restype = None
+        gvc.gvFreeRenderData.argtypes = [ctypes.c_void_p]
+
+        cgraph.agmemread.restype = ctypes.c_void_p
+        cgraph.agmemread.argtypes = [ctypes.c_char_p]
+        cgraph.agclose.restype = ctypes.c_int
+        cgraph.agclose.argtypes = [ctypes.c_void_p]
+
+        state['context'] = gvc.gvContext()
+        if not state['context']:
+            state['gvc'] = False
+            return False
+
+        state['cgraph'] = cgraph
+        state['gvc'] = gvc
+        return True
+
+
+def available():
+    """Tell whether graphs can be rendered through the libraries."""
+    return load()
+
+
+def render(data, prog, format):
+    """Lay out and render a graph given in dot language as bytes."""
+    if not load():
+        raise pydot.InvocationException('GraphViz\'s libraries not found')
+
+    gvc, cgraph, context = state['gvc'], state['cgraph'], state['context']
+
+    with lock:
+        graph = cgraph.agmemread(data)
+        if not graph:
+            raise pydot.InvocationException(
+                'GraphViz couldn\'t read the graph')
+
+        try:
+            if gvc.gvLayout(context, graph, prog.encode('ascii')) != 0:
+                raise pydot.InvocationException(
+                    'GraphViz couldn\'t lay out the graph with "%s"' % prog)
+
+            try:
+                result = ctypes.c_void_p()
+                length = ctypes.c_size_t(0)
+                status = gvc.gvRenderData(
+                    context, graph, format.encode('ascii'),
+                    ctypes.byref(result), ctypes.byref(length))
+                if status != 0:
+                    raise pydot.InvocationException(
+                        'GraphViz couldn\'t render the graph as "%s"' % format)
+
+                try:
+                    return ctypes.string_at(result, length.value)
+                finally:
+                    gvc.gvFreeRenderData(result)
+            finally:
+                gvc.gvFreeLayout(context, graph)
+        finally:
+            cgraph.agclose(graph)
@@ -0,0 +1,335 @@
+"""Reading of the positions Graphviz computes into compact arrays.
+
+Used by Dot.create_layout(), it reads the 'plain', 'plain-ext' and
+'json' output formats without building any Node or Edge. SpatialIndex
+answers hit-tests and viewport queries against a Layout.
+"""
+import json
+import math
+import re
+from array import array
+
+
+# The tokens of a line of the plain format, names may be quoted and
+# followed by a port with plain-ext.
+PLAIN_TOKEN_RE = re.compile(r'(?:"(?:[^"\\]|\\.)*"|[^\s"])+')
+QUOTED_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# Graphviz gives sizes, and the coordinates of the plain format, in inches.
+POINTS_PER_INCH = 72.0
+
+
+class Layout(object):
+    """The positions of the nodes and edges of a graph, in points.
+
+    Node 'i' is named names[i], centered at (x[i], y[i]) and has a size
+    of node_width[i] by node_height[i]. 'width' and 'height' are the
+    size of the whole graph. Edge 'j' goes from node edge_tail[j] to
+    node edge_head[j], the control points of its spline are at indices
+    edge_offsets[j] to edge_offsets[j + 1] of points_x and points_y.
+    Where NumPy is available numpy.frombuffer() makes arrays of them
+    without copying.
+    """
+
+    def __init__(self):
+        self.width = 0.0
+        self.height = 0.0
+        self.names = []
+        self.index = dict()
+        self.x = array('d')
+        self.y = array('d')
+        self.node_width = array('d')
+        self.node_height = array('d')
+        self.edge_tail = array('l')
+        self.edge_head = array('l')
+        self.edge_offsets = array('l', [0])
+        self.points_x = array('d')
+        self.points_y = array('d')
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_node(self, name, x, y, width, height):
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.x.append(x)
+        self.y.append(y)
+        self.node_width.append(width)
+        self.node_height.append(height)
+
+    def add_edge(self, tail, head, points_x, points_y):
+        self.edge_tail.append(tail)
+        self.edge_head.append(head)
+        self.points_x.extend(points_x)
+        self.points_y.extend(points_y)
+        self.edge_offsets.append(len(self.points_x))
+
+    def get_position(self, name):
+        """Return the center of the node named 'name'."""
+        i = self.index[name]
+        return self.x[i], self.y[i]
+
+    def get_edge_points(self, j):
+        """Return the control points of the spline of edge 'j'."""
+        start, end = self.edge_offsets[j], self.edge_offsets[j + 1]
+        return list(zip(self.points_x[start:end], self.points_y[start:end]))
+
+    def get_spatial_index(self, cell_size=None):
+        """Return a SpatialIndex over the nodes and edges."""
+        return SpatialIndex(self, cell_size)
+
+
+def distance_to_segment(x, y, x0, y0, x1, y1):
+    dx, dy = x1 - x0, y1 - y0
+    length = dx * dx + dy * dy
+    if length == 0:
+        return math.hypot(x - x0, y - y0)
+    t = max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / length))
+    return math.hypot(x - x0 - t * dx, y - y0 - t * dy)
+
+
+class SpatialIndex(object):
+    """A uniform grid over the bounding boxes of the elements of a Layout.
+
+    Each node and edge is registered in the square cells of side
+    'cell_size' its bounding box overlaps, so that a query only looks
+    at the elements of the cells it touches instead of all of them. The
+    cell size defaults to the largest average node dimension, keeping
+    a few nodes per cell.
+
+    The layout shouldn't be changed once indexed.
+    """
+
+    def __init__(self, layout, cell_size=None):
+        self.layout = layout
+
+        if cell_size is None:
+            count = len(layout) or 1
+            cell_size = max(
+                sum(layout.node_width) / count,
+                sum(layout.node_height) / count)
+        self.cell_size = float(cell_size) or 1.0
+
+        # Boxes are kept as (x0, y0, x1, y1) in flat arrays.
+        self.node_boxes = array('d')
+        self.edge_boxes = array('d')
+        self.node_cells = dict()
+        self.edge_cells = dict()
+
+        for i in range(len(layout)):
+            half_width = layout.node_width[i] / 2
+            half_height = layout.node_height[i] / 2
+            self.add(self.node_cells, self.node_boxes, i, (
+                layout.x[i] - half_width, layout.y[i] - half_height,
+                layout.x[i] + half_width, layout.y[i] + half_height))
+
+        offsets = layout.edge_offsets
+        for j in range(len(offsets) - 1):
+            start, end = offsets[j], offsets[j + 1]
+            if start == end:
+                # Edges without spline can't be hit.
+                self.edge_boxes.extend((0.0, 0.0, -1.0, -1.0))
+                continue
+            points_x = layout.points_x[start:end]
+            points_y = layout.points_y[start:end]
+            self.add(self.edge_cells, self.edge_boxes, j, (
+                min(points_x), min(points_y), max(points_x), max(points_y)))
+
+    def get_cells(self, x0, y0, x1, y1):
+        size = self.cell_size
+        return (
+            range(int(math.floor(x0 / size)), int(math.floor(x1 / size)) + 1),
+            range(int(math.floor(y0 / size)), int(math.floor(y1 / size)) + 1))
+
+    def add(self, cells, boxes, i, box):
+        boxes.extend(box)
+        columns, rows = self.get_cells(*box)
+        for column in columns:
+            for row in rows:
+                cells.setdefault((column, row), []).append(i)
+
+    def find(self, cells, boxes, x0, y0, x1, y1):
+        columns, rows = self.get_cells(x0, y0, x1, y1)
+
+        # A box wider than the graph would visit mostly empty cells.
+        if len(columns) * len(rows) > len(cells):
+            candidates = set(i for bucket in cells.values() for i in bucket)
+        else:
+            candidates = set()
+            for column in columns:
+                for row in rows:
+                    candidates.update(cells.get((column, row), ()))
+
+        found = []
+        for i in candidates:
+            k = 4 * i
+            if (boxes[k] <= x1 and x0 <= boxes[k + 2] and
+                    boxes[k + 1] <= y1 and y0 <= boxes[k + 3]):
+                found.append(i)
+        found.sort()
+        return found
+
+    def nodes_in(self, x0, y0, x1, y1):
+        """Return the indices of the nodes overlapping a rectangle."""
+        return self.find(self.node_cells, self.node_boxes, x0, y0, x1, y1)
+
+    def edges_in(self, x0, y0, x1, y1):
+        """Return the indices of the edges whose spline's bounding box
+        overlaps a rectangle."""
+        return self.find(self.edge_cells, self.edge_boxes, x0, y0, x1, y1)
+
+    def node_at(self, x, y):
+        """Return the index of the node under a point, or None.
+
+        Nodes are hit within their bounding box. When several overlap,
+        the one whose center is the closest wins.
+        """
+        layout = self.layout
+        found = self.nodes_in(x, y, x, y)
+        if not found:
+            return None
+        return min(found, key=lambda i: (
+            math.hypot(layout.x[i] - x, layout.y[i] - y), i))
+
+    def edge_at(self, x, y, tolerance=2.0):
+        """Return the index of the edge passing within 'tolerance' of a
+        point, or None.
+
+        The distance is measured to the lines between the control points
+        of the splines, which stay close to the curves Graphviz draws.
+        """
+        layout = self.layout
+        best = None
+        best_distance = tolerance
+        for j in self.edges_in(
+                x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            start, end = layout.edge_offsets[j], layout.edge_offsets[j + 1]
+            points_x = layout.points_x
+            points_y = layout.points_y
+            for k in range(start, max(end - 1, start + 1)):
+                m = min(k + 1, end - 1)
+                distance = distance_to_segment(
+                    x, y, points_x[k], points_y[k], points_x[m], points_y[m])
+                if distance <= best_distance:
+                    if best is None or distance < best_distance:
+                        best, best_distance = j, distance
+        return best
+
+
+def get_name(token):
+    """Return the node name in a token of the plain format, without port."""
+    if token.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', QUOTED_RE.match(token).group(1))
+    # Names with a colon are quoted, it can only start a port.
+    return token.partition(':')[0]
+
+
+def parse_plain(data):
+    """Read the 'plain' or 'plain-ext' output of Graphviz into a Layout."""
+    layout = Layout()
+    scale = POINTS_PER_INCH
+
+    for line in data.splitlines():
+        if not line:
+            continue
+
+        # Splitting on whitespace is much faster, when nothing is quoted.
+        if '"' in line:
+            tokens = PLAIN_TOKEN_RE.findall(line)
+        else:
+            tokens = line.split()
+
+        if tokens[0] == 'node':
+            layout.add_node(
+                get_name(tokens[1]),
+                float(tokens[2]) * scale, float(tokens[3]) * scale,
+                float(tokens[4]) * scale, float(tokens[5]) * scale)
+
+        elif tokens[0] == 'edge':
+            count = int(tokens[3])
+            coordinates = tokens[4:4 + 2 * count]
+            layout.add_edge(
+                layout.index[get_name(tokens[1])],
+                layout.index[get_name(tokens[2])],
+                [float(value) * scale for value in coordinates[0::2]],
+                [float(value) * scale for value in coordinates[1::2]])
+
+        elif tokens[0] == 'graph':
+            layout.width = float(tokens[2]) * scale
+            layout.height = float(tokens[3]) * scale
+
+    return layout
+
+
+def parse_spline(pos):
+    # Splines are given as 'e,x,y s,x,y x1,y1 x2,y2 ...', the points
+    # starting with 'e' and 's' are where arrowheads end.
+    points_x = []
+    points_y = []
+    for point in pos.split():
+        if point[:2] in ('e,', 's,'):
+            continue
+        x, y = point.split(',')[:2]
+        points_x.append(float(x))
+        points_y.append(float(y))
+    return points_x, points_y
+
+
+def parse_json(data):
+    """Read the 'json' or 'json0' output of Graphviz into a Layout."""
+    return read_json(json.loads(data))
+
+
+def read_json(graph):
+    """Read the decoded 'json' or 'json0' output of Graphviz into a Layout.
+
+    Node 'i' of the layout is the object at index i + graph['_subgraph_cnt']
+    and edge 'j' the edge at index j.
+    """
+    layout = Layout()
+
+    bb = graph.get('bb')
+    if bb:
+        x0, y0, x1, y1 = [float(value) for value in bb.split(',')]
+        layout.width = x1 - x0
+        layout.height = y1 - y0
+
+    # The subgraphs come first among the objects, the nodes after them.
+    gvids = dict()
+    objects = graph.get('objects', [])
+    for obj in objects[graph.get('_subgraph_cnt', 0):]:
+        x, y = obj.get('pos', '0,0').split(',')[:2]
+        gvids[obj['_gvid']] = len(layout)
+        layout.add_node(
+            obj['name'], float(x), float(y),
+            float(obj.get('width', 0)) * POINTS_PER_INCH,
+            float(obj.get('height', 0)) * POINTS_PER_INCH)
+
+    for edge in graph.get('edges', []):
+        points_x, points_y = parse_spline(edge.get('pos', ''))
+        layout.add_edge(
+            gvids[edge['tail']], gvids[edge['head']], points_x, points_y)
+
+    return layout
+
+
+PARSERS = {
+    'plain': parse_plain,
+    'plain-ext': parse_plain,
+    'json': parse_json,
+    'json0': parse_json,
+}
+
+
+def parse_layout(data, format):
+    """Read the output of Graphviz in 'format' into a Layout."""
+    if format not in PARSERS:
+        import pydot_ng as pydot
+        raise pydot.Error(
+            'Invalid layout format "%s". Accepted formats are: %s' % (
+                format, ', '.join(sorted(PARSERS))))
+
+    if not isinstance(data, str):
+        data = data.decode('utf-8')
+
+    return PARSERS[format](data)
@@ -3,10 +3,15 @@
 from __future__ import division
 from __future__ import print_function
 
+import bz2
+import gzip
+import io
 import os
+import subprocess
 import sys
 import warnings
 from textwrap import dedent
+from timeit import default_timer
 
 import mock
 import pytest
@@ -155,6 +160,184 @@ def test_parse_multiple_graphs():
     assert sorted(g.get_name() for g in graphs) == sorted(["A", "B"])
 
 
+def test_parsed_elements_are_linked_to_top_graph():
+    graph_data = dedent(
+        """\
+        digraph G {
+            a; a [color=red];
+            subgraph s1 { b -> c; subgraph s2 { node [shape=box]; d } }
+            { e } -> f;
+        }
+        """
+    )
+    graph = pydot.graph_from_dot_data(graph_data)
+
+    def check(obj_dict):
+        for key in ("nodes", "edges", "subgraphs"):
+            for obj_dicts in obj_dict[key].values():
+                for obj in obj_dicts:
+                    assert obj["parent_graph"] is graph
+                    if key == "subgraphs":
+                        check(obj)
+
+    check(graph.obj_dict)
+    assert [n.get_color() for n in graph.get_node("a")] == [None, "red"]
+
+
+def test_edge_chain():
+    graph = pydot.graph_from_dot_data(
+        "digraph G { a -> b:p -> c -> {d e} -> f [color=red]; }"
+    )
+    edges = sorted(graph.get_edges(), key=lambda e: e.get_sequence())
+
+    assert len(edges) == 4
+    assert [(e.get_source(), e.get_destination()) for e in edges[:2]] == [
+        ("a", "b:p"),
+        ("b:p", "c"),
+    ]
+    assert isinstance(edges[2].get_destination(), pydot.frozendict)
+    assert edges[3].get_source() == edges[2].get_destination()
+    assert edges[3].get_destination() == "f"
+    assert all(e.get_color() == "red" for e in edges)
+
+    edges[0].set_color("blue")
+    assert edges[1].get_color() == "red"
+
+
+def test_lazy_subgraphs():
+    graph_data = dedent(
+        """\
+        digraph G {
+            a -> b;
+            subgraph cluster_x { label="{x}"; c -> d; subgraph inner { e } }
+            subgraph s { f } -> g;
+        }
+        """
+    )
+    graph = pydot.graph_from_dot_data(graph_data, lazy=True)
+
+    assert "lazy_source" in graph.obj_dict["subgraphs"]["cluster_x"][0]
+
+    cluster = graph.get_subgraph("cluster_x")[0]
+    assert "lazy_source" not in cluster.obj_dict
+    assert cluster.get_label() == '"{x}"'
+    assert cluster.get_edges()[0].get_source() == "c"
+    assert cluster.get_subgraph("inner")[0].get_parent_graph() is graph
+
+    eager = pydot.graph_from_dot_data(graph_data)
+    assert graph.to_string() == eager.to_string()
+
+
+def test_lazy_graph_is_picklable_and_copyable(tmpdir):
+    import copy
+    import pickle
+
+    path = tmpdir.join("lazy.dot")
+    path.write("digraph G { a -> b; subgraph cluster_x { c -> d; } }")
+    graph = pydot.graph_from_dot_file(str(path), lazy=True)
+    assert "lazy_source" in graph.obj_dict["subgraphs"]["cluster_x"][0]
+
+    for loaded in (pickle.loads(pickle.dumps(graph)), copy.deepcopy(graph)):
+        cluster = loaded.get_subgraph("cluster_x")[0]
+        assert cluster.get_edges()[0].get_source() == "c"
+        assert loaded.to_string() == graph.to_string()
+
+
+def test_lazy_subgraphs_are_read_from_the_file(tmpdir):
+    path = tmpdir.join("lazy.dot")
+    path.write("digraph G { subgraph cluster_x { a } subgraph y { b } }")
+    graph = pydot.graph_from_dot_file(str(path), lazy=True)
+
+    source, idx = graph.obj_dict["subgraphs"]["cluster_x"][0]["lazy_source"]
+    assert source.data is None
+    assert source.read(idx).strip() == "a"
+
+    path.write("digraph G { subgraph cluster_x { cc } subgraph y { d } }")
+    with pytest.raises(pydot.Error):
+        graph.get_subgraph("y")
+    assert "lazy_source" in graph.obj_dict["subgraphs"]["y"][0]
+
+
+def test_dot_stats():
+    graph_data = dedent(
+        """\
+        strict digraph G {
+            rankdir=LR;
+            node [shape=box];
+            a -> b -> c [color=red];
+            subgraph cluster_0 { label="x"; d; e -> {f g} }
+            "a" -> h:p;
+        }
+        """
+    )
+    stats = pydot.dot_stats(graph_data)
+
+    assert stats == {
+        "graph_type": "digraph",
+        "strict": True,
+        "nodes": 8,
+        "edges": 5,
+        "subgraphs": 2,
+        "clusters": 1,
+        "max_depth": 2,
+        "attributes": ["color", "label", "rankdir", "shape"],
+    }
+
+
+def test_dot_stats_multiple_graphs():
+    stats = pydot.dot_stats(b"graph A { a -- b } graph B { c }")
+
+    assert [s["nodes"] for s in stats] == [2, 1]
+    assert [s["edges"] for s in stats] == [1, 0]
+
+
+def test_dot_stats_tokens_follow_the_grammar():
+    # The parser ends quoted IDs at the first quote, backslash or not.
+    graph_data = r'digraph G { a -> "x\"; b -> c [weight=-2]; "y" }'
+    graph = pydot.graph_from_dot_data(graph_data)
+
+    stats = pydot.dot_stats(graph_data)
+
+    assert stats["nodes"] == 5
+    assert stats["edges"] == len(graph.get_edge_list()) == 2
+    assert stats["attributes"] == ["weight"]
+
+
+def test_dot_stats_from_file():
+    path = os.path.join(MY_REGRESSION_TESTS_DIR, "parsing_test.dot")
+
+    stats = pydot.dot_stats(path)
+    with open(path, "rb") as f:
+        assert stats == pydot.dot_stats(f)
+    assert stats["graph_type"] == "digraph"
+
+
+@pytest.mark.parametrize("compression", ("none", "gzip", "bz2"))
+def test_graph_from_dot_stream(compression):
+    path = os.path.join(REGRESSION_TESTS_DIR, "Latin1.dot")
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if compression == "gzip":
+        stream = io.BytesIO()
+        with gzip.GzipFile(fileobj=stream, mode="wb") as f:
+            f.write(data)
+        data = stream.getvalue()
+    elif compression == "bz2":
+        data = bz2.compress(data)
+
+    graph = pydot.graph_from_dot_stream(io.BytesIO(data))
+    assert graph.to_string() == pydot.graph_from_dot_file(path).to_string()
+
+
+def test_graph_from_dot_stream_text():
+    graph_data = u"digraph G { a -> b }"
+
+    graph = pydot.graph_from_dot_stream(io.StringIO(graph_data))
+    expected = pydot.graph_from_dot_data(graph_data)
+    assert graph.to_string() == expected.to_string()
+
+
 def test_numeric_node_id(digraph):
     digraph.add_node(pydot.Node(1))
     assert digraph.get_nodes()[0].get_name() == "1"
@@ -229,6 +412,890 @@ def test_graph_add_subgraph_argument_type(digraph, subgraph):
     )
 
 
+# The script fake_dot runs by default, echoing its input after a lot of
+# stderr.
+ECHO_SCRIPT = """\
+#!{python}
+import sys
+sys.stderr.write("warning\\n" * 100000)
+sys.stdout.write(sys.stdin.read())
+"""
+
+
+@pytest.fixture
+def fake_dot(request, tmpdir):
+    """A script standing in for Graphviz, written to tmpdir as dot.
+
+    Tests running another script than ECHO_SCRIPT pass it through
+    with_fake_dot(). It's formatted with 'python', the interpreter
+    running the tests, and 'tmpdir'. Tests using it are skipped on
+    Windows, which can't run scripts as programs.
+    """
+    if sys.platform == "win32":
+        pytest.skip("needs a script as dot")
+    script = getattr(request, "param", ECHO_SCRIPT)
+    prog = tmpdir.join("dot")
+    prog.write(
+        dedent(script).format(python=sys.executable, tmpdir=str(tmpdir))
+    )
+    prog.chmod(0o755)
+    return str(prog)
+
+
+def with_fake_dot(script):
+    """Make the fake_dot fixture of a test run the given script."""
+    return pytest.mark.parametrize(
+        "fake_dot", [script], indirect=True, ids=["fake_dot"]
+    )
+
+
+def test_create_pipes_graph_and_reads_stderr(fake_dot, capsys):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    data = graph.create(format="dot")
+
+    assert data == graph.to_string().encode("utf-8")
+    assert "warning" in capsys.readouterr().out
+
+
+def test_render_cache(fake_dot, tmpdir):
+    cache = pydot.RenderCache(directory=str(tmpdir.join("cache")))
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_render_cache(cache)
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    data = graph.create(format="dot")
+
+    graph.set_graphviz_executables({"dot": "invalid"})
+    assert graph.create(format="dot") == data
+    with pytest.raises(pydot.InvocationException):
+        graph.create(format="svg")
+
+    cache.clear()
+    assert graph.create(format="dot") == data
+
+
+def test_render_cache_evicts_least_recently_used():
+    cache = pydot.RenderCache(max_bytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.set("c", b"1234")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"1234"
+    assert cache.size == 8
+
+
+@pytest.mark.parametrize("ordered", (True, False))
+def test_render_many(fake_dot, ordered):
+    graphs = []
+    for i in range(10):
+        graph = pydot.Dot("graph%d" % i, graph_type="digraph")
+        graph.set_graphviz_executables({"dot": fake_dot})
+        graphs.append(graph)
+    graphs[3].set_graphviz_executables({"dot": "invalid"})
+
+    results = list(
+        pydot.render_many(
+            graphs, format="dot", max_workers=3, ordered=ordered
+        )
+    )
+
+    if ordered:
+        assert [r.index for r in results] == list(range(10))
+    results.sort(key=lambda r: r.index)
+    for i, result in enumerate(results):
+        assert result.graph is graphs[i]
+        if i == 3:
+            assert result.data is None
+            assert isinstance(result.error, pydot.InvocationException)
+        else:
+            assert result.error is None
+            assert result.data == graphs[i].to_string().encode("utf-8")
+
+
+@pytest.mark.skipif(not PY3, reason="needs asyncio")
+@with_fake_dot(
+    # Each run records how many runs there are at the same time.
+    """\
+    #!{python}
+    import os, sys, time
+    running = os.path.join({tmpdir!r}, "running")
+    mark = os.path.join(running, str(os.getpid()))
+    open(mark, "w").close()
+    with open(os.path.join({tmpdir!r}, "log"), "a") as f:
+        f.write("%d\\n" % len(os.listdir(running)))
+    time.sleep(0.2)
+    os.remove(mark)
+    sys.stdout.write(sys.stdin.read())
+    """
+)
+def test_acreate_and_awrite(fake_dot, tmpdir):
+    import asyncio
+
+    tmpdir.mkdir("running")
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    path = str(tmpdir.join("graph.dot"))
+
+    async def render():
+        semaphore = asyncio.Semaphore(2)
+        results = await asyncio.gather(
+            *[graph.acreate(format="dot", semaphore=semaphore)
+              for _ in range(5)]
+        )
+        await graph.awrite(path, format="dot")
+        return results
+
+    loop = asyncio.new_event_loop()
+    results = loop.run_until_complete(render())
+    loop.close()
+
+    expected = graph.to_string().encode("utf-8")
+    assert results == [expected] * 5
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+    counts = [int(count) for count in tmpdir.join("log").readlines()]
+    assert len(counts) == 6
+    assert max(counts) == 2
+
+
+@pytest.mark.skipif(not PY3, reason="needs asyncio")
+@with_fake_dot("#!/bin/sh\nexec sleep 60\n")
+def test_acreate_timeout_kills_program(fake_dot):
+    import asyncio
+
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    loop = asyncio.new_event_loop()
+    with pytest.raises(pydot.InvocationException) as exc_info:
+        loop.run_until_complete(graph.acreate(format="dot", timeout=0.5))
+    loop.close()
+    assert "timed out" in str(exc_info.value)
+    assert isinstance(exc_info.value, pydot.InvocationTimeout)
+
+
+# A stand-in for Graphviz handling many graphs and the -O option.
+BATCH_SCRIPT = """\
+#!{python}
+import os
+import re
+import sys
+import time
+with open(os.path.join({tmpdir!r}, "runs"), "a") as f:
+    f.write("run\\n")
+fmt = [a[2:] for a in sys.argv if a.startswith("-T")][0]
+if "-O" in sys.argv:
+    data = open(sys.argv[-1]).read()
+else:
+    data = sys.stdin.read()
+graphs = re.findall(r"^\\w+ \\w+ {{.*?^}}$", data, re.M | re.S)
+for i, graph in enumerate(graphs):
+    if "fail" in graph:
+        sys.stderr.write("error in graph %d" % i)
+        sys.exit(1)
+    if "slow" in graph:
+        time.sleep(60)
+    if "-O" not in sys.argv:
+        sys.stdout.write(graph + "\\n")
+        continue
+    name = sys.argv[-1]
+    if i:
+        name += ".%d" % (i + 1)
+    with open(name + "." + fmt, "w") as f:
+        f.write(graph + "\\n")
+"""
+
+
+@with_fake_dot(BATCH_SCRIPT)
+def test_render_batch(fake_dot, tmpdir):
+    graphs = []
+    for i in range(5):
+        graph = pydot.Dot("graph%d" % i, graph_type="digraph")
+        graph.set_graphviz_executables({"dot": fake_dot})
+        graphs.append(graph)
+    graphs[3].add_node(pydot.Node("fail"))
+
+    results = pydot.render_batch(graphs, format="dot")
+
+    assert [r.index for r in results] == list(range(5))
+    for i, result in enumerate(results):
+        assert result.graph is graphs[i]
+        if i == 3:
+            assert result.data is None
+            assert "error in graph 0" in str(result.error)
+        else:
+            assert result.error is None
+            assert result.data == graphs[i].to_string().encode("utf-8")
+    # One run for the batch, then one for each graph from the failed one.
+    assert tmpdir.join("runs").read().count("run") == 3
+
+
+@with_fake_dot(BATCH_SCRIPT)
+def test_render_batch_timeout(fake_dot, tmpdir):
+    graphs = []
+    for i in range(5):
+        graph = pydot.Dot("graph%d" % i, graph_type="digraph")
+        graph.set_graphviz_executables({"dot": fake_dot})
+        graph.set_limits(timeout=1)
+        if i >= 2:
+            graph.add_node(pydot.Node("slow"))
+        graphs.append(graph)
+
+    start = default_timer()
+    results = pydot.render_batch(graphs, format="dot")
+
+    # The batch times out in graph 2, the output of graph 1 may not be
+    # complete. Rendering graph 1 and 2 again takes the rest of the
+    # time, graph 3 and 4 aren't run.
+    assert default_timer() - start < 3
+    for result in results[:2]:
+        assert result.data == result.graph.to_string().encode("utf-8")
+    for result in results[2:]:
+        assert isinstance(result.error, pydot.InvocationTimeout)
+    assert tmpdir.join("runs").read().count("run") == 3
+
+
+@with_fake_dot(
+    """\
+    #!{python}
+    import os
+    import sys
+    with open(os.path.join({tmpdir!r}, "runs"), "a") as f:
+        f.write("run\\n")
+    data = open(sys.argv[-1]).read()
+    for arg in sys.argv:
+        if arg.startswith("-T"):
+            fmt = arg[2:]
+            suffix = ".".join(reversed(fmt.split(":")))
+            with open(sys.argv[-1] + "." + suffix, "w") as f:
+                f.write(fmt + " " + data)
+    """
+)
+def test_create_multi(fake_dot, tmpdir):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    graph.set_render_cache(pydot.RenderCache())
+    data = graph.to_string()
+
+    outputs = graph.create_multi(["svg", "png:cairo", "svg"])
+
+    assert outputs == {
+        "svg": ("svg " + data).encode(),
+        "png:cairo": ("png:cairo " + data).encode(),
+    }
+    assert graph.create_multi(["png:cairo"]) == {
+        "png:cairo": outputs["png:cairo"]
+    }
+    assert graph.create(format="svg") == outputs["svg"]
+    assert tmpdir.join("runs").read().count("run") == 1
+
+
+def test_layout_cache_fingerprint_ignores_style():
+    def make_graph(edges=(("a", "b"),), **attrs):
+        graph = pydot.Dot("G", graph_type="digraph")
+        graph.add_node(pydot.Node("a", **attrs))
+        for src, dst in edges:
+            graph.add_edge(pydot.Edge(src, dst))
+        return cache.get_fingerprint(graph)
+
+    cache = pydot.LayoutCache()
+    fingerprint = make_graph(color="red")
+
+    assert make_graph(color="blue", label="A") == fingerprint
+    assert make_graph(color="red", shape="box") != fingerprint
+    assert make_graph((("a", "b"), ("b", "c")), color="red") != fingerprint
+
+
+def test_layout_cache_fingerprint_includes_prog():
+    graph = pydot.Dot("G", graph_type="digraph")
+    graph.add_edge(pydot.Edge("a", "b"))
+    cache = pydot.LayoutCache()
+
+    fingerprint = cache.get_fingerprint(graph)
+    assert cache.get_fingerprint(graph, "dot") == fingerprint
+    assert cache.get_fingerprint(graph, "neato") != fingerprint
+    graph.set_prog("neato")
+    assert cache.get_fingerprint(graph) != fingerprint
+
+
+@with_fake_dot(
+    """\
+    #!{python}
+    import os
+    import sys
+    with open(os.path.join({tmpdir!r}, "runs"), "a") as f:
+        f.write("dot\\n")
+    path = sys.argv[-1]
+    with open(path + ".dot", "w") as f:
+        f.write('digraph G {{ graph [bb="0,0,54,108"]; '
+                'a [pos="27,90"]; b [pos="27,18"]; '
+                'a -> b [pos="e,27,36 27,71"]; }}')
+    with open(path + ".svg", "w") as f:
+        f.write("laid out")
+    """
+)
+@pytest.mark.parametrize("a, b", (("a", "b"), ('"a"', '"b"')))
+def test_layout_cache_renders_with_pinned_positions(fake_dot, tmpdir, a, b):
+    neato = tmpdir.join("neato")
+    neato.write("#!/bin/sh\necho \"$@\"\ncat\n")
+    neato.chmod(0o755)
+
+    graph = pydot.Dot("G", graph_type="digraph")
+    graph.add_node(pydot.Node(a, color="red"))
+    graph.add_edge(pydot.Edge(a, b))
+    graph.set_graphviz_executables({"dot": fake_dot, "neato": str(neato)})
+    cache = pydot.LayoutCache()
+
+    assert cache.create(graph, format="svg") == b"laid out"
+
+    graph.get_node(a)[0].set_color("blue")
+    before = graph.to_string()
+    output = cache.create(graph, format="svg").decode()
+
+    # Graphviz writes the names without their quotes.
+    assert output.startswith("-Tsvg -n2")
+    assert a + ' [color=blue, pos="27,90"]' in output
+    assert 'b [pos="27,18"]' in output
+    assert output.count(" [pos=") == 2
+    assert 'pos="e,27,36 27,71"' in output
+    assert 'bb="0,0,54,108"' in output
+    assert graph.to_string() == before
+    assert tmpdir.join("runs").read().count("dot") == 1
+
+
+PLAIN_LAYOUT = b"""\
+graph 1 1.25 2.5
+node a 0.375 2.25 0.75 0.5 a solid ellipse black lightgrey
+node "b c" 0.375 0.25 0.75 0.5 "b c" solid ellipse black lightgrey
+edge a "b c":p 4 0.375 1.99 0.375 1.6 0.375 1.2 0.375 0.85 solid black
+stop
+"""
+
+JSON_LAYOUT = b"""{
+  "name": "G", "directed": true, "bb": "0,0,90,180", "_subgraph_cnt": 1,
+  "objects": [
+    {"_gvid": 0, "name": "cluster_x", "nodes": [1]},
+    {"_gvid": 1, "name": "a", "pos": "27,162", "width": "0.75",
+     "height": "0.5"},
+    {"_gvid": 2, "name": "b c", "pos": "27,18", "width": "0.75",
+     "height": "0.5"}
+  ],
+  "edges": [
+    {"_gvid": 0, "tail": 1, "head": 2,
+     "pos": "e,27,36.1 27,143.7 27,115.4 27,85 27,61.2"}
+  ]
+}"""
+
+
+@pytest.mark.parametrize(
+    "format, data",
+    (
+        ("plain", PLAIN_LAYOUT),
+        ("plain-ext", PLAIN_LAYOUT),
+        ("json", JSON_LAYOUT),
+    ),
+)
+def test_create_layout(format, data):
+    graph = pydot.Dot("G", graph_type="digraph")
+
+    with mock.patch.object(graph, "create", return_value=data) as create:
+        layout = graph.create_layout(format=format)
+    create.assert_called_once_with(prog=None, format=format)
+
+    assert len(layout) == 2
+    assert layout.names == ["a", "b c"]
+    assert layout.get_position("a") == pytest.approx((27, 162))
+    assert layout.get_position("b c") == pytest.approx((27, 18))
+    assert list(layout.node_width) == pytest.approx([54, 54])
+    assert list(layout.node_height) == pytest.approx([36, 36])
+    assert (layout.width, layout.height) == pytest.approx((90, 180))
+    assert list(layout.edge_tail) == [0]
+    assert list(layout.edge_head) == [1]
+    points = layout.get_edge_points(0)
+    assert len(points) == 4
+    assert points[0][0] == pytest.approx(27)
+    assert points[-1][1] == pytest.approx(61.2)
+
+
+def test_create_layout_invalid_format():
+    graph = pydot.Dot("G", graph_type="digraph")
+
+    with mock.patch.object(graph, "create", return_value=b""):
+        with pytest.raises(pydot.Error):
+            graph.create_layout(format="png")
+
+
+def test_spatial_index():
+    graph = pydot.Dot("G", graph_type="digraph")
+
+    with mock.patch.object(graph, "create", return_value=PLAIN_LAYOUT):
+        index = graph.create_layout().get_spatial_index()
+
+    assert index.node_at(27, 162) == 0
+    assert index.node_at(50, 30) == 1
+    assert index.node_at(80, 100) is None
+    assert index.edge_at(28, 100) == 0
+    assert index.edge_at(40, 100) is None
+    assert index.nodes_in(0, 100, 90, 200) == [0]
+    assert index.nodes_in(-1e6, -1e6, 1e6, 1e6) == [0, 1]
+    assert index.edges_in(0, 0, 90, 100) == [0]
+    assert index.edges_in(60, 0, 90, 180) == []
+
+
+def test_tile_renderer(fake_dot, tmpdir):
+    graph = pydot.Dot("G", graph_type="digraph")
+    graph.set_node_defaults(shape="box")
+    graph.add_edge(pydot.Edge("a", "b c"))
+    graph.set_graphviz_executables({"dot": fake_dot, "neato": fake_dot})
+    renderer = pydot.TileRenderer(graph, str(tmpdir), format="dot")
+
+    with mock.patch.object(graph, "create", return_value=JSON_LAYOUT):
+        renderer.lay_out()
+
+    assert renderer.get_tile_box(1, 0, 1) == (0, 0, 90, 90)
+    assert renderer.get_tile_graph(1, 1, 0) is None
+
+    tile = renderer.get_tile_graph(2, 0, 3).to_string()
+    assert 'viewport="256,256,5.688' in tile
+    assert 'pos="27,18"' in tile
+    assert "node [shape=box];" in tile
+    assert "a -> \"b c\"" in tile
+
+    paths = renderer.render(zoom_levels=(0, 1))
+    assert [os.path.relpath(path, renderer.directory) for path in paths] == [
+        os.path.join("0", "0", "0.dot"),
+        os.path.join("1", "0", "0.dot"),
+        os.path.join("1", "0", "1.dot"),
+    ]
+    with open(paths[0]) as f:
+        assert f.read() == renderer.get_tile_graph(0, 0, 0).to_string()
+
+    # Tiles and the layout are reused from the directory.
+    renderer = pydot.TileRenderer(graph, str(tmpdir), format="dot")
+    with mock.patch("pydot_ng.render_many") as render_many:
+        assert renderer.render(zoom_levels=(0, 1)) == paths
+    assert list(render_many.call_args[0][0]) == []
+
+
+def test_get_components():
+    graph = pydot.graph_from_dot_data(
+        "digraph G { label=x; node [shape=box]; a -> b; c -> \"d e\":p; "
+        "f; subgraph cluster_1 { g; h; } b -> a; }"
+    )
+
+    components = [
+        component.to_string() for component in pydot.get_components(graph)
+    ]
+    assert len(components) == 4
+    assert all("node [shape=box];" in component for component in components)
+    assert not any("label" in component for component in components)
+    assert any("a -> b;\nb -> a;" in component for component in components)
+    assert any("cluster_1 {\ng;\nh;\n}" in c for c in components)
+
+
+def test_translate_positions():
+    translate = pydot.translate_positions
+    spline = translate('"e,27,36.1 27,143.7"', 10, 100)
+    assert spline == '"e,37,136.1 37,243.7"'
+    assert translate("0,0,90,180", 1, 2) == "1,2,91,182"
+    assert translate('"3,4!"', 1, 1) == '"4,5!"'
+
+
+def test_create_packed():
+    graph = pydot.Dot("G", graph_type="digraph")
+    graph.add_edge(pydot.Edge("a", "b"))
+    graph.add_node(pydot.Node("c"))
+
+    layouts = {
+        False: 'digraph G { graph [bb="0,0,54,108"]; a [pos="27,90"]; '
+        'b [pos="27,18"]; a -> b [pos="e,27,36 27,72 27,60 27,48"]; }',
+        True: 'digraph G { graph [bb="0,0,54,36"]; c [pos="27,18"]; }',
+    }
+
+    def render_many(graphs, format, prog, max_workers):
+        return [
+            pydot.RenderResult(
+                i, component, layouts["c;" in component.to_string()], None
+            )
+            for i, component in enumerate(graphs)
+        ]
+
+    with mock.patch("pydot_ng.render_many", side_effect=render_many):
+        with mock.patch.object(
+            graph, "create", side_effect=lambda **kwargs: graph.to_string()
+        ) as create:
+            data = graph.create_packed(format="svg")
+    create.assert_called_once_with(prog=["neato", "-n2"], format="svg")
+
+    # The taller component goes above, in a row of its own.
+    assert 'bb="0,0,54.000,152.000"' in data
+    assert 'a [pos="27,134"];' in data
+    assert 'c [pos="27,18"];' in data
+    assert 'pos="e,27,80 27,116 27,104 27,92"' in data
+    assert graph.to_string() == "digraph G {\na -> b;\nc;\n}\n"
+
+
+@pytest.mark.parametrize(
+    "graph_type, nodes, edges, clusters, prog",
+    (
+        ("digraph", 100, 200, 0, "dot"),
+        ("digraph", 5000, 10000, 0, "dot"),
+        ("digraph", 50000, 100000, 0, "sfdp"),
+        ("digraph", 50000, 100000, 3, "fdp"),
+        ("digraph", 5000, 10000, 3, "dot"),
+        ("graph", 100, 1500, 3, "fdp"),
+        ("digraph", 100, 1500, 0, "sfdp"),
+        ("graph", 500, 1000, 0, "neato"),
+        ("graph", 5000, 10000, 0, "sfdp"),
+    ),
+)
+def test_prog_policy_choose(graph_type, nodes, edges, clusters, prog):
+    stats = {
+        "graph_type": graph_type,
+        "nodes": nodes,
+        "edges": edges,
+        "clusters": clusters,
+    }
+
+    chosen = pydot.ProgPolicy().choose(stats)
+    assert (chosen if isinstance(chosen, str) else chosen[0]) == prog
+
+
+def test_create_auto_prog(fake_dot):
+    graph = pydot.graph_from_dot_data("graph G { a -- b; }")
+    graph.set_graphviz_executables({"neato": fake_dot})
+    graph.set_prog("auto")
+
+    assert graph.create(format="dot") == graph._to_bytes()
+    job = graph._prepare_create(None, "dot")
+    assert job["prog"] == "neato"
+    assert job["cmdline"] == [fake_dot, "-Tdot"]
+
+
+def test_create_auto_prog_falls_back(fake_dot, tmpdir):
+    slow = tmpdir.join("slow")
+    slow.write("#!/bin/sh\nexec sleep 60\n")
+    slow.chmod(0o755)
+    graph = pydot.Dot("G", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": str(slow), "sfdp": fake_dot})
+    graph.set_prog_policy(pydot.ProgPolicy(time_budget=0.5))
+
+    data = graph.create(prog="auto", format="dot")
+    assert data == graph._to_bytes()
+
+    # Without time left for the fallback the timeout is raised.
+    with pytest.raises(pydot.InvocationTimeout):
+        graph.create(prog="auto", format="dot", timeout=0.5)
+
+
+def test_get_output_suffix():
+    assert pydot.get_output_suffix("png") == "png"
+    assert pydot.get_output_suffix("png:cairo:gd") == "gd.cairo.png"
+
+
+def test_create_libgvc_backend_falls_back_to_program(fake_dot):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    with mock.patch("pydot_ng._gvc.available", return_value=False):
+        data = graph.create(format="dot", backend="libgvc")
+
+    assert data == graph.to_string().encode("utf-8")
+
+
+def test_create_invalid_backend():
+    graph = pydot.Dot("graphname", graph_type="digraph")
+
+    with pytest.raises(pydot.Error):
+        graph.create(format="dot", backend="invalid")
+
+
+@with_fake_dot("#!/bin/sh\npwd\ncat shape.png\n")
+def test_shape_files_are_staged_once(fake_dot, tmpdir):
+    shape = tmpdir.join("shape.png")
+    shape.write("image")
+    stage = pydot.ShapeFileStage(max_dirs=0)
+
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.shape_file_stage = stage
+    graph.set_shape_files(str(shape))
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    with mock.patch.object(stage, "link", wraps=stage.link) as link:
+        directory = stage.acquire([str(shape)])
+        first = graph.create(format="dot")
+        second = graph.create(format="dot")
+        assert link.call_count == 1
+
+    assert first == second
+    work_dir, content = first.decode().split("\n")[:2]
+    assert os.path.realpath(work_dir) == os.path.realpath(directory)
+    assert content == "image"
+    assert os.path.isdir(directory)
+    stage.release(directory)
+    assert not os.path.exists(directory)
+
+
+def test_create_stream(fake_dot, tmpdir):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.add_node(pydot.Node("a" * 200000))
+    graph.set_graphviz_executables({"dot": fake_dot})
+    expected = graph.to_string().encode("utf-8")
+
+    with graph.create(format="dot", stream=True) as stream:
+        assert b"".join(stream) == expected
+
+    path = str(tmpdir.join("graph.dot"))
+    graph.write(path, format="dot")
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+    stream = graph.create(format="dot", stream=True)
+    assert stream.read(10) == expected[:10]
+    stream.close()
+
+
+FAILING_SCRIPT = "#!/bin/sh\ncat\necho failed >&2\nexit 3\n"
+
+
+@with_fake_dot(FAILING_SCRIPT)
+def test_create_stream_raises_on_close(fake_dot):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+
+    stream = graph.create(format="dot", stream=True)
+    assert stream.read() == graph.to_string().encode("utf-8")
+    with pytest.raises(pydot.InvocationException) as exc_info:
+        stream.close()
+    assert "failed" in str(exc_info.value)
+
+
+@with_fake_dot(FAILING_SCRIPT)
+def test_write_failure_keeps_file(fake_dot, tmpdir):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    path = tmpdir.mkdir("out").join("graph.dot")
+
+    with pytest.raises(pydot.InvocationException):
+        graph.write(str(path), format="dot")
+    assert tmpdir.join("out").listdir() == []
+
+    path.write("previous")
+    with pytest.raises(pydot.InvocationException):
+        graph.write(str(path), format="dot")
+    assert tmpdir.join("out").listdir() == [path]
+    assert path.read() == "previous"
+
+
+@pytest.mark.skipif(not PY3, reason="needs asyncio")
+@with_fake_dot(FAILING_SCRIPT)
+def test_awrite_failure_keeps_file(fake_dot, tmpdir):
+    import asyncio
+
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    path = tmpdir.join("graph.dot")
+    path.write("previous")
+
+    loop = asyncio.new_event_loop()
+    with pytest.raises(pydot.InvocationException):
+        loop.run_until_complete(graph.awrite(str(path), format="dot"))
+    loop.close()
+    assert tmpdir.listdir(lambda p: p.basename != "dot") == [path]
+    assert path.read() == "previous"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="needs links")
+def test_write_keeps_links(tmpdir):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    target = tmpdir.join("target.dot")
+    target.write("previous")
+    symlink = tmpdir.join("symlink.dot")
+    symlink.mksymlinkto(target)
+    hardlink = tmpdir.join("hardlink.dot")
+    hardlink.mklinkto(target)
+
+    graph.write(str(symlink))
+    assert symlink.islink()
+    assert target.read() == graph.to_string()
+
+    graph.set_name("other")
+    graph.write(str(hardlink))
+    assert target.read() == graph.to_string()
+
+
+def test_write_fills_render_cache(fake_dot, tmpdir):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_render_cache(pydot.RenderCache())
+    graph.set_graphviz_executables({"dot": fake_dot})
+    path = str(tmpdir.join("graph.dot"))
+
+    graph.write(path, format="dot")
+    graph.set_graphviz_executables({"dot": "invalid"})
+
+    assert graph.create(format="dot") == graph.to_string().encode("utf-8")
+
+
+@with_fake_dot("#!/bin/sh\necho partial >&2\nsleep 60 &\nwait\n")
+@pytest.mark.parametrize("stream", (False, True))
+def test_create_timeout_kills_process_group(fake_dot, stream):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    graph.set_limits(timeout=0.5)
+
+    with pytest.raises(pydot.InvocationTimeout) as exc_info:
+        result = graph.create(format="dot", stream=stream)
+        if stream:
+            result.read()
+            result.close()
+
+    assert "partial" in exc_info.value.stderr
+
+
+@pytest.mark.skipif(
+    os.name != "posix", reason="resource limits are only set on POSIX"
+)
+@with_fake_dot("#!/bin/sh\ncat >/dev/null\nulimit -t\nulimit -v\n")
+def test_create_resource_limits(fake_dot):
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    graph.set_limits(cpu_time=5)
+
+    data = graph.create(format="dot", address_space=1024 * 1024 * 1024)
+
+    assert data.split() == [b"5", b"1048576"]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="sessions are POSIX only")
+def test_popen_limits_start_a_session_only_when_limited():
+    assert pydot.get_popen_limits({"timeout": None}) == {}
+
+    kwargs = pydot.get_popen_limits({"timeout": 5})
+    assert kwargs.get("start_new_session") or "preexec_fn" in kwargs
+
+    # The resource limits are set before the program starts.
+    assert "preexec_fn" in pydot.get_popen_limits({"cpu_time": 5})
+
+
+@with_fake_dot("#!/bin/sh\nexec sleep 60\n")
+@pytest.mark.parametrize("stream", (False, True))
+def test_create_reaps_program_on_error(fake_dot, stream):
+    def hook(phase, duration, info):
+        if phase == "create.spawn":
+            raise RuntimeError("hook failed")
+
+    graph = pydot.Dot("graphname", graph_type="digraph")
+    graph.set_graphviz_executables({"dot": fake_dot})
+    graph.add_instrumentation_hook(hook)
+    processes = []
+    popen = subprocess.Popen
+
+    def spawn(*args, **kwargs):
+        processes.append(popen(*args, **kwargs))
+        return processes[-1]
+
+    with mock.patch("subprocess.Popen", spawn):
+        with pytest.raises(RuntimeError):
+            graph.create(format="dot", stream=stream)
+
+    assert processes[0].returncode is not None
+
+
+def test_invocation_timeout_is_picklable():
+    import pickle
+
+    error = pickle.loads(pickle.dumps(pydot.InvocationTimeout("late", "err")))
+    assert str(error) == "late"
+    assert error.stderr == "err"
+
+
+def test_instrumentation_hooks(fake_dot, capsys):
+    calls = []
+
+    def hook(phase, duration, info):
+        assert duration >= 0
+        calls.append((phase, info))
+
+    pydot.add_instrumentation_hook(hook)
+    try:
+        graph = pydot.graph_from_dot_data(
+            b"digraph G { a -> b -> c; subgraph s { d } }"
+        )
+    finally:
+        pydot.remove_instrumentation_hook(hook)
+
+    assert calls == [
+        ("parse.decode", {"bytes": 43, "chars": 43}),
+        (
+            "parse.parse",
+            {"graphs": 1, "nodes": 1, "edges": 2, "subgraphs": 1},
+        ),
+    ]
+
+    del calls[:]
+    graph.set_graphviz_executables({"dot": fake_dot})
+    graph.create(format="dot")
+    assert calls == []
+
+    graph.add_instrumentation_hook(hook)
+    data = graph.create(format="dot")
+    capsys.readouterr()
+
+    assert [phase for phase, info in calls] == [
+        "create.serialize",
+        "create.spawn",
+        "create.run",
+    ]
+    assert calls[0][1] == {"bytes": len(data)}
+    assert calls[2][1]["status"] == 0
+    assert calls[2][1]["stdout_bytes"] == len(data)
+
+
+def test_format_methods_use_current_prog():
+    graph = pydot.Dot()
+    graph.set_prog("neato")
+
+    with mock.patch.object(graph, "create") as create:
+        graph.create_svg()
+    create.assert_called_once_with(prog=None, format="svg")
+    assert "create_svg" not in graph.__dict__
+    assert "set_label" not in graph.__dict__
+
+    with mock.patch.object(graph, "write") as write:
+        graph.write_raw("path")
+    write.assert_called_once_with("path", prog=None, format="raw")
+
+
+def test_write_format_methods_pass_limits(tmpdir):
+    graph = pydot.Dot()
+    path = str(tmpdir.join("graph.png"))
+
+    with mock.patch.object(graph, "create") as create:
+        create.return_value = io.BytesIO(b"png")
+        graph.write_png(path, timeout=5, cpu_time=2)
+
+    create.assert_called_once_with(
+        "dot", "png", stream=True, timeout=5, cpu_time=2, address_space=None
+    )
+    assert tmpdir.join("graph.png").read_binary() == b"png"
+
+
+def test_attribute_methods_are_defined_on_classes():
+    cluster = pydot.Cluster("c")
+    cluster.set_pencolor("red")
+    cluster.set_label("C")
+    assert cluster.get_pencolor() == "red"
+    assert cluster.get_label() == "C"
+    assert not hasattr(pydot.Graph("g"), "set_pencolor")
+    assert pydot.Node.set_label is not pydot.Edge.set_label
+
+
 def test_quoting():
     import string
 
@@ -281,6 +1348,113 @@ def test_dotparser_import_warning():
             import pydot_ng  # noqa: F401
 
 
+# Seconds importing pydot_ng may take, far more than it needs, to catch
+# an expensive import creeping in rather than to measure it.
+IMPORT_BUDGET = 1.0
+
+
+@pytest.mark.skipif(not PY3, reason="the parser is imported right away")
+def test_import_is_fast_and_does_not_load_the_parser():
+    code = dedent(
+        """\
+        import sys
+        from timeit import default_timer
+        start = default_timer()
+        import pydot_ng
+        print(default_timer() - start)
+        print(" ".join(m for m in ("pyparsing", "pydot_ng._dotparser")
+                       if m in sys.modules))
+        """
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+
+    elapsed, loaded = output.decode().split("\n")[:2]
+    if pydot.LAZY_IMPORTS:
+        assert loaded == ""
+    assert float(elapsed) < IMPORT_BUDGET
+    assert pydot.dot_parser.parse_dot_data("graph G {}") is not None
+    assert pydot.id_re_num.match("123")
+
+
+@pytest.mark.skipif(not PY3, reason="the parser is imported right away")
+def test_dot_stats_does_not_load_the_parser():
+    code = dedent(
+        """        import sys
+        import pydot_ng
+        stats = pydot_ng.dot_stats("digraph G { a -> b }")
+        print(stats["edges"])
+        print(" ".join(m for m in ("pyparsing", "pydot_ng._dotparser")
+                       if m in sys.modules))
+        """
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+
+    edges, loaded = output.decode().split("\n")[:2]
+    assert edges == "1"
+    if pydot.LAZY_IMPORTS:
+        assert loaded == ""
+
+
+def test_find_graphviz_is_cached(tmpdir, monkeypatch):
+    tmpdir.join("dot").write("")
+    monkeypatch.delenv(pydot.GRAPHVIZ_PATH_VARIABLE, raising=False)
+    monkeypatch.setenv("PATH", str(tmpdir))
+
+    with mock.patch(
+        "pydot_ng.__find_executables",
+        wraps=pydot.__find_executables,
+    ) as find_executables:
+        progs = pydot.find_graphviz()
+        assert progs["dot"] == str(tmpdir.join("dot"))
+        progs["dot"] = "changed"
+        assert pydot.find_graphviz()["dot"] == str(tmpdir.join("dot"))
+        assert find_executables.call_count == 1
+
+        other = tmpdir.mkdir("other")
+        other.join("dot").write("")
+        monkeypatch.setenv("PATH", str(other))
+        assert pydot.find_graphviz()["dot"] == str(other.join("dot"))
+
+        pydot.find_graphviz(refresh=True)
+        assert find_executables.call_count == 3
+
+
+def test_find_graphviz_environment_override(tmpdir, monkeypatch):
+    tmpdir.join("dot").write("")
+    monkeypatch.setenv(pydot.GRAPHVIZ_PATH_VARIABLE, str(tmpdir))
+    assert pydot.find_graphviz()["dot"] == str(tmpdir.join("dot"))
+
+    monkeypatch.setenv(pydot.GRAPHVIZ_PATH_VARIABLE, str(tmpdir.mkdir("x")))
+    assert pydot.find_graphviz() is None
+
+
+@with_fake_dot(
+    """\
+    #!/bin/sh
+    case "$1" in
+    -T*) echo 'Format: "?" not recognized. Use one of: svg png' >&2;;
+    -K*) echo 'Layout: "?" not recognized. Use one of: dot' >&2;;
+    esac
+    exit 1
+    """
+)
+def test_probe_graphviz(fake_dot):
+    capabilities = pydot.probe_graphviz(fake_dot)
+
+    assert capabilities == {"formats": ["png", "svg"], "layouts": ["dot"]}
+    graph = pydot.Dot()
+    graph.set_graphviz_executables({"dot": fake_dot})
+    assert graph.get_supported_formats() == ["png", "svg"]
+    graph.set_graphviz_executables({"dot": "invalid"})
+    assert graph.get_supported_formats() == graph.formats
+
+
 def test_find_executables_fake_path():
     assert pydot.__find_executables("/fake/path/") is None
 
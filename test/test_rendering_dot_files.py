@@ -7,7 +7,10 @@ import subprocess
 import sys
 from hashlib import sha256
 
+import pytest
+
 import pydot_ng as pydot
+from pydot_ng import _gvc
 
 PY3 = not sys.version_info < (3, 0, 0)
 
@@ -37,7 +40,10 @@ def list_dots(path):
 
 
 def pytest_generate_tests(metafunc):
-    if metafunc.function != test_render_and_compare_dot_files:
+    if metafunc.function not in (
+        test_render_and_compare_dot_files,
+        test_render_with_libgvc_and_compare_dot_files,
+    ):
         return
 
     idlist = []
@@ -83,11 +89,13 @@ def _render_with_graphviz(filename):
     return sha256(stdout_output).hexdigest()
 
 
-def _render_with_pydot(filename):
+def _render_with_pydot(filename, backend="subprocess"):
     g = pydot.graph_from_dot_file(filename)
     if not isinstance(g, list):
         g = [g]
-    jpe_data = NULL_SEP.join([_g.create(format="jpe") for _g in g])
+    jpe_data = NULL_SEP.join(
+        [_g.create(format="jpe", backend=backend) for _g in g]
+    )
     return sha256(jpe_data).hexdigest()
 
 
@@ -98,6 +106,14 @@ def test_render_and_compare_dot_files(filepath):
     assert original_data_hexdigest == parsed_data_hexdigest
 
 
+@pytest.mark.skipif(not _gvc.available(), reason="libgvc not found")
+def test_render_with_libgvc_and_compare_dot_files(filepath):
+    parsed_data_hexdigest = _render_with_pydot(filepath, backend="libgvc")
+    original_data_hexdigest = _render_with_graphviz(filepath)
+
+    assert original_data_hexdigest == parsed_data_hexdigest
+
+
 def test_graph_with_shapefiles():
     shapefile_dir = os.path.join(TEST_DIR, "from-past-to-future")
     dot_file = os.path.join(shapefile_dir, "from-past-to-future.dot")